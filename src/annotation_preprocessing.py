@@ -1,42 +1,89 @@
+import argparse
 import pandas as pd
-import json
 import spacy
 from sklearn.model_selection import train_test_split
 import numpy as np
+from collections import OrderedDict
+from itertools import islice
+from progress import Progress
+from prodigy_reader import read_jsonl
 
 
-def find_org_loc(doc, org):
+def org_index(doc):
     """
-    Function to get the start and end indices of the company mention in the news article
+    Maps each entity text in a parsed article to its first location
 
-    :param doc:
-    :param org:
-    :return:
+    :param doc: the parsed news article
+    :return: dict with the entity texts as keys and (start index, end index, sentence) tuples as values
+    :rtype: dict
     """
 
-    # Find all Named Entities in the article
+    index = dict()
     for sent in doc.sents:
         for ent in sent.ents:
-            # Extract start and end indices of company mention
-            if ent.text == org:
-                loc_begin = ent.start_char
-                loc_end = ent.end_char
-                return loc_begin, loc_end, sent.text
+            if ent.text not in index:
+                index[ent.text] = (ent.start_char, ent.end_char, sent.text)
 
-    return None
+    return index
 
 
-def extract_annotations():
+def clean_article(article):
+    """Removes the quotes from an article, as was done before NER"""
+
+    return article.replace('"', '').replace("'", "")
+
+
+def indexed_annotations(examples, nlp, batch_size=256, n_process=1, cache_size=10000):
+    """
+    Adds the entity index of its article to each annotation sample
+
+    The samples are processed in batches. Each unique article in a batch is parsed once with nlp.pipe,
+    and the indexes of recently seen articles are kept in an LRU cache, because several samples
+    annotate mentions in the same article. Only the small indexes are kept, not the parsed docs.
+
+    :param examples: iterable of annotation samples
+    :param nlp: spaCy nlp object to perform NER
+    :param batch_size: the number of samples per batch
+    :param n_process: the number of processes nlp.pipe uses
+    :param cache_size: the number of article indexes to keep
+    :return: generator of (sample, cleaned article, entity index) tuples
+    """
+
+    cache = OrderedDict()
+    examples = iter(examples)
+    while True:
+        batch = list(islice(examples, batch_size))
+        if not batch:
+            break
+
+        # Parse the articles of this batch that are not in the cache yet
+        articles = [clean_article(example['article']) for example in batch]
+        new_articles = [article for article in dict.fromkeys(articles) if article not in cache]
+        docs = nlp.pipe(new_articles, batch_size=min(batch_size, 64), n_process=n_process)
+        for article, doc in zip(new_articles, docs):
+            cache[article] = org_index(doc)
+
+        for example, article in zip(batch, articles):
+            cache.move_to_end(article)
+            yield example, article, cache[article]
+
+        # Forget the least recently used articles
+        while len(cache) > cache_size:
+            cache.popitem(last=False)
+
+
+def extract_annotations(json_loc="../data/prodigy_data/annotations+iaa_output.jsonl", n_process=1):
     """
     Prepares annotations from Prodigy to save them as a .tsv file
 
+    :param json_loc: the Prodigy export with the annotations
+    :param n_process: the number of processes used for NER
     :return: A dataframe with input data and labels
     :rtype: pandas.core.frame.DataFrame
     """
 
     # Prepare resources
     nlp = spacy.load("resources/nen_nlp")
-    json_loc = "../data/prodigy_data/annotations+iaa_output.jsonl"
 
     # Prepare dict to store information in
     annotations = {'article':[], 'sent': [], 'small_context': [], 'org': [], 'loc_begin': [], 'loc_end': [], 'label': []}
@@ -49,74 +96,66 @@ def extract_annotations():
     o_articles = set()
     annotator_1 = 0
     used_annotator_1 = 0
+    progress = Progress('extract_annotations', unit='samples')
+
+    # Go through all annotations, each article is parsed once
+    examples = read_jsonl(json_loc, fields=['_session_id', 'title', 'intro', 'slice', 'article', 'org', 'accept'])
+    for example, article, index in indexed_annotations(examples, nlp, n_process=n_process):
+        progress.update(accepted=accepted, ner_mismatches=mismatch)
+        i += 1
+
+        # Count annotations per annotator
+        if example['_session_id'] == "annotations3-Jona":
+            annotator_1 += 1
 
-    # Go through all annotations
-    with open(json_loc, 'r', encoding='utf8') as jsonfile:
-        for line in jsonfile:
-
-            # Print progress
-            if i%100 == 0:
-                print(f"{i} samples preprocessed.")
-            i += 1
-
-            # Load annotation sample
-            example = json.loads(line)
-
-            # Count annotations per annotator
-            if example['_session_id'] == "annotations3-Jona":
-                annotator_1 += 1
-
-            # Define context
-            title = example['title']
-            intro = example['intro']
-            text_slice = example['slice']
-            context = f"{title}. {intro}{text_slice}"
-
-            # Extract full article for NER
-            article = example['article']
-            o_articles.add(article)
-            article = article.replace('"', '')
-            article = article.replace("'", "")
-
-            org_text = example['org']
-
-            # Find offset of organisation in context
-            doc = nlp(article)
-            if find_org_loc(doc, org_text):
-                loc_begin, loc_end, sent = find_org_loc(doc, org_text)
-            else:
-
-                # Skip the sample if company mention is not recognised by spaCy's NER
-                mismatch += 1
-                print(f"{mismatch} NER mismatches.")
-                continue
-
-            # Save accepted answer
-            if example['accept']:
-                if example['accept'][0] not in ["NIL_notanorg", "NIL_otherentity", "NIL_ambiguous"]:
-                    kvk = str(example['accept'][0])
-
-                    # Samples were annotated with outdated KvK-numbers
-                    if len(kvk) == 7:
-                        kvk = '0'+kvk
-
-                    accepted += 1
-
-                    # Count number of samples one of the annotators did
-                    if example['_session_id'] == "annotations3-Jona":
-                        used_annotator_1 += 1
-
-                    # Save info in a dict
-                    annotations['article'].append(article)
-                    annotations['sent'].append(sent)
-                    annotations['small_context'].append(context)
-                    annotations['org'].append(org_text)
-                    annotations['loc_begin'].append(loc_begin)
-                    annotations['loc_end'].append(loc_end)
-                    annotations['label'].append(kvk)
-
-                elif example['accept'][0] == 'NIL_otherentity':
-                    nil += 1
+        # Define context
+        title = example['title']
+        intro = example['intro']
+        text_slice = example['slice']
+        context = f"{title}. {intro}{text_slice}"
+
+        # The full article was cleaned for NER
+        o_articles.add(example['article'])
+
+        org_text = example['org']
+
+        # Find offset of organisation in context
+        if org_text in index:
+            loc_begin, loc_end, sent = index[org_text]
+        else:
+
+            # Skip the sample if company mention is not recognised by spaCy's NER
+            mismatch += 1
+            continue
+
+        # Save accepted answer
+        if example['accept']:
+            if example['accept'][0] not in ["NIL_notanorg", "NIL_otherentity", "NIL_ambiguous"]:
+                kvk = str(example['accept'][0])
+
+                # Samples were annotated with outdated KvK-numbers
+                if len(kvk) == 7:
+                    kvk = '0'+kvk
+
+                accepted += 1
+
+                # Count number of samples one of the annotators did
+                if example['_session_id'] == "annotations3-Jona":
+                    used_annotator_1 += 1
+
+                # Save info in a dict
+                annotations['article'].append(article)
+                annotations['sent'].append(sent)
+                annotations['small_context'].append(context)
+                annotations['org'].append(org_text)
+                annotations['loc_begin'].append(loc_begin)
+                annotations['loc_end'].append(loc_end)
+                annotations['label'].append(kvk)
+
+            elif example['accept'][0] == 'NIL_otherentity':
+                nil += 1
+
+    progress.close(accepted=accepted, ner_mismatches=mismatch)
 
     # Transform dict to pandas DataFrame
     annotations_df = pd.DataFrame.from_dict(annotations)
@@ -124,7 +163,7 @@ def extract_annotations():
 
     # Print statistics
     print()
-    print(f"{accepted} mentions linked, {nil} NIL mentions.")
+    print(f"{accepted} mentions linked, {nil} NIL mentions, {mismatch} NER mismatches.")
     print(f"Linked {annotations_df.shape[0]} of {i} mentions in {len(a_articles)} of {len(o_articles)} articles.")
     print()
     print(f"{annotator_1} samples annotated by annotator 1, {i-annotator_1} samples annotated by annotator 2.")
@@ -181,10 +220,14 @@ def save_data(annotations_df):
     print()
 
 
-def main():
-    annotations_df = extract_annotations()
+def main(n_process=1):
+    annotations_df = extract_annotations(n_process=n_process)
     save_data(annotations_df)
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Converts the Prodigy annotations into training, development and test data.")
+    parser.add_argument('--n-process', type=int, default=1, help="Number of processes for NER")
+    args = parser.parse_args()
+
+    main(args.n_process)
@@ -0,0 +1,158 @@
+import argparse
+import json
+import platform
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import spacy
+
+import evaluation
+from kb_snapshot import load_kb
+from profiling import peak_memory
+from utils import load_companies
+
+SYSTEMS = ['el_system', 'baseline', 'baseline_context', 'majority']
+
+
+def load_system(system):
+    """
+    Loads all resources a linking system needs
+
+    :param system: the name of the system
+    :return: a function that predicts KvK-numbers for a batch of test samples
+    """
+
+    if system == 'el_system':
+        nlp = spacy.load('resources/nen_nlp_el_sentence')
+        return lambda batch: evaluation.system_predictions(batch, nlp, batch_size=len(batch))
+
+    if system == 'majority':
+        nlp = spacy.load('resources/nen_nlp_el_sentence')
+        kb = load_kb('resources/kb_probs', nlp.vocab)
+        return lambda batch: evaluation.majority_baseline(batch, kb)
+
+    # Both name-matching baselines need the company names and the fitted vectorizer
+    companies = load_companies().explode('all_names')
+    vectorizer, clean_matrix = evaluation.fit_vectorizer(companies)
+
+    if system == 'baseline':
+        return lambda batch: evaluation.baseline_predictions(batch, companies, vectorizer, clean_matrix)
+
+    if system == 'baseline_context':
+        context_model = evaluation.load_context_model(companies)
+        return lambda batch: evaluation.baseline_context_predictions(batch, companies, vectorizer, clean_matrix,
+                                                                     context_model)
+
+    raise ValueError(f"Unknown system: {system}")
+
+
+def benchmark_system(system, test_data, batch_size):
+    """
+    Replays the test data through one system in batches and measures its costs
+
+    Runs in a fresh process, so that the cold start and the peak memory belong to this system only.
+
+    :param system: the name of the system
+    :param test_data: the preprocessed test samples
+    :param batch_size: the number of mentions per batch
+    :return: dict with the cold start time, throughput, latency percentiles and peak memory
+    :rtype: dict
+    """
+
+    # Cold start: load all resources the system needs
+    start = time.perf_counter()
+    predict = load_system(system)
+    cold_start = time.perf_counter() - start
+    loaded_memory = peak_memory()
+
+    # Link all test mentions batch by batch
+    batch_times = []
+    latencies = []
+    for begin in range(0, len(test_data), batch_size):
+        batch = test_data[begin:begin + batch_size]
+        start = time.perf_counter()
+        predict(batch)
+        batch_time = time.perf_counter() - start
+
+        # Every mention in a batch waits for the whole batch
+        batch_times.append((len(batch), batch_time))
+        latencies.extend([batch_time] * len(batch))
+
+    # Leave out the first batch for the steady state, it pays for lazy initialisation
+    steady = batch_times[1:] if len(batch_times) > 1 else batch_times
+    steady_mentions = sum(n for n, seconds in steady)
+    steady_time = sum(seconds for n, seconds in steady)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+
+    return {'system': system,
+            'batch_size': batch_size,
+            'n_mentions': len(test_data),
+            'cold_start_s': round(cold_start, 3),
+            'mentions_per_sec': round(steady_mentions / steady_time, 2) if steady_time else None,
+            'latency_ms': {'p50': round(float(p50), 3), 'p95': round(float(p95), 3), 'p99': round(float(p99), 3)},
+            'loaded_rss_mb': round(loaded_memory, 1),
+            'peak_rss_mb': round(peak_memory(), 1)}
+
+
+def git_revision():
+    """Returns the commit the benchmark was run on, if available"""
+
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(systems, batch_sizes, test_loc="../data/model_data/test_data.tsv", limit=None):
+    """
+    Benchmarks each system at each batch size, each run in a separate process
+
+    :param systems: the names of the systems to benchmark
+    :param batch_sizes: the batch sizes to benchmark
+    :param test_loc: path to the test data
+    :param limit: only replay the first `limit` test mentions
+    :return: the benchmark report
+    :rtype: dict
+    """
+
+    gold_labels, test_data = evaluation.preprocess(test_loc)
+    if limit:
+        test_data = test_data[:limit]
+
+    results = []
+    for system in systems:
+        for batch_size in batch_sizes:
+            print(f"Benchmarking {system} with batch size {batch_size}...")
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(benchmark_system, system, test_data, batch_size).result()
+            print(f"{result['mentions_per_sec']} mentions/sec, p95 latency {result['latency_ms']['p95']} ms.")
+            results.append(result)
+
+    return {'revision': git_revision(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'spacy': spacy.__version__,
+            'test_data': test_loc,
+            'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures latency, throughput and memory of the linking systems.")
+    parser.add_argument('--systems', nargs='+', choices=SYSTEMS, default=SYSTEMS)
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 8, 32])
+    parser.add_argument('--test-data', default="../data/model_data/test_data.tsv")
+    parser.add_argument('--limit', type=int, default=None, help="Only replay the first LIMIT test mentions")
+    parser.add_argument('--output', default="../data/model_data/benchmark.json")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.systems, args.batch_sizes, args.test_data, args.limit)
+    with open(args.output, 'w', encoding='utf8') as outfile:
+        json.dump(report, outfile, indent=2)
+    print(f"Saved benchmark results in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
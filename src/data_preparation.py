@@ -1,10 +1,13 @@
 import pandas as pd
 import jsonlines
-from utils import string_to_list
+from utils import load_news
+from dedup import load_clusters
+from progress import Progress
 import spacy
 from spacy.kb import KnowledgeBase
 import re
-from utils import get_orgs
+from collections import defaultdict
+from utils import doc_orgs
 
 
 def highlight(text, org):
@@ -16,48 +19,65 @@ def highlight(text, org):
     :return: HTML object of text with highlighted company
     """
 
-    # Find locations of the company
-    occurrences = [m.start() for m in re.finditer(org, text)]
+    # Mark every occurrence of the company in one pass, the mention is matched literally
+    return re.sub(re.escape(org), lambda match: f"<mark>{match.group()}</mark>", text)
 
-    # Add highlight to each occurrence of the company
-    for n, begin in enumerate(occurrences):
-        begin += 13*n
-        end = begin+len(org)
-        text = f"{text[:begin]}<mark>{text[begin:end]}</mark>{text[end:]}"
 
-    return text
+def highlight_spans(text, spans, offset=0):
+    """
+    Highlights the company mention at the character offsets of its entity spans
+
+    :param text: the text to be presented, an article or a slice of it
+    :param spans: (start_char, end_char) tuples of the mention in the article
+    :param offset: the position of the text in the article, to shift the spans with
+    :return: HTML object of text with highlighted company
+    """
+
+    parts = []
+    last = 0
+    for begin, end in spans:
+        begin, end = begin - offset, end - offset
+
+        # Skip spans that fall (partly) outside the text
+        if begin < last or end > len(text):
+            continue
+
+        parts.extend([text[last:begin], '<mark>', text[begin:end], '</mark>'])
+        last = end
+    parts.append(text[last:])
 
+    return ''.join(parts)
 
-def org_mention(org, text, size=500):
+
+def org_mention(text, begin, size=500):
     """
-    Extracts the portion of the article in which the company mention occured first
+    Extracts the portion of the article around a company mention
 
-    :param org: the company mention
     :param text: the full company text
+    :param begin: the character offset of the company mention in the article
     :param size: the desired character size of the portion
-    :return: the text slice in which the company mention occurred first
+    :return: the text slice in which the company mention occurs and the offset of the slice in the article
     """
 
     # Number of characters to include before and after the company mention
     length = size//2
 
-    # Find the index of the company mention in the news article
-    begin = text.find(org)
+    # Select the index of the begin and end of the text slice, within the article
+    begin_slice = max(begin-length, 0)
+    end_slice = min(begin+length, len(text))
+
+    return text[begin_slice:end_slice], begin_slice
 
-    # Select the index of the begin and end of the text slice
-    begin_slice = begin-length
-    end_slice = begin+length
 
-    # Adjust indices if they exceed beginning or end of article
-    if end_slice > len(text):
-        end_slice = len(text)
-    if begin_slice < 0:
-        begin_slice = 0
+def mention_spans(doc):
+    """Maps the text of each ORG/NORP entity in a doc to the character offsets of all its occurrences"""
 
-    # Take the slice
-    text_slice = text[begin_slice:end_slice]
+    spans = defaultdict(list)
+    for ent in doc.ents:
+        if ent.label_ in ['ORG', 'NORP']:
+            spans[ent.text].append((ent.start_char, ent.end_char))
 
-    return '...'+text_slice+'...'
+    return spans
 
 
 def sbi_addition(sbi_code):
@@ -68,20 +88,20 @@ def sbi_addition(sbi_code):
     return link
 
 
-def prodigy_input():
+def prodigy_input(batch_size=64):
     """Transforms data to be annotated in right format for the Prodigy annotation environment."""
 
     # Load news article data
-    data_path = "../data/model_data/prepro_news.tsv"
-    news = pd.read_csv(data_path, sep='\t')
+    news = load_news(columns=['title', 'full_text', 'url', 'intro'])
+    clusters = load_clusters(news['full_text'])
 
     # Load resources
     nlp = spacy.load("resources/nen_nlp")
     kb = KnowledgeBase(vocab=nlp.vocab, entity_vector_length=300)
     kb.load_bulk("resources/kb_initial")
 
-    # Extract all aliases from the Knowledge Base
-    kb_aliases = kb.get_alias_strings()
+    # Extract all aliases from the Knowledge Base, as a set for constant time lookups
+    kb_aliases = set(kb.get_alias_strings())
 
     # Prepare variables
     counter = 0
@@ -89,17 +109,27 @@ def prodigy_input():
     mult_cands = 0
     mult_cand_articles = 0
 
+    # Near-duplicates of an article would give the same annotation samples, only take the representatives
+    articles = ((article, (title, url, intro))
+                for n, (title, article, url, intro) in enumerate(zip(news['title'],
+                                                                      news['full_text'],
+                                                                      news['url'],
+                                                                      news['intro']))
+                if clusters is None or clusters[n] == n)
+    n_articles = len(news) if clusters is None else len(set(clusters))
+
     # Save all annotation samples as lines in a JSON lines files
+    progress = Progress('prodigy_input', total=n_articles, unit='articles')
     with jsonlines.open('../data/prodigy_data/annotations_input.jsonl', "w") as writer:
 
-        # Go through all news data
-        for n, (title, article, url, intro) in enumerate(zip(news['title'],
-                                              news['full_text'],
-                                              news['url'],
-                                              news['intro'])):
+        # Go through all news data, NER runs in batches
+        for doc, (title, url, intro) in nlp.pipe(articles, as_tuples=True, batch_size=batch_size):
+            progress.update(samples=counter)
+            article = doc.text
 
-            # Extract company mentions
-            orgs = get_orgs(article, nlp)
+            # Extract company mentions and the locations of all their occurrences
+            orgs = doc_orgs(doc)
+            spans = mention_spans(doc)
 
             # Set flags
             mult_cand_flag = False
@@ -112,10 +142,6 @@ def prodigy_input():
                 if org.text in kb_aliases:
                     article_flag = True
 
-                    # Print progress
-                    if counter % 10 == 0:
-                        print(f"{counter} company mentions saved for annotation.")
-
                     # Select only company mentions with multiple candidates and count them for statistics
                     if len(kb.get_candidates(org.text)) > 1:
                         mult_cands += 1
@@ -124,29 +150,23 @@ def prodigy_input():
                     # Save full article if it is shorter than 1000 characters
                     if len(article) < 1000:
 
-                        # Highlight the company mention
-                        h_article = highlight(article, org.text)
-                        displayed_text = h_article
+                        # Highlight the company mention, there is no slice
+                        displayed_text = highlight_spans(article, spans[org.text])
+                        slice_text = ""
 
                     # Extract relevant portions for articles longer than 1000 characters
                     else:
                         # Check if the first paragraph/introduction is available
-                        if type(intro) != str:
+                        if type(intro) != str or not intro:
                             continue
 
-                        # Highlight company mentions in introduction if possible
-                        try:
-                            h_intro = highlight(intro, org.text)
-                        except:
+                        # Highlight company mentions in introduction
+                        h_intro = highlight(intro, org.text)
 
-                            # If not possible, save the unhighlighted texts
-                            print("Intro:", intro)
-                            print("Org:", org.text)
-                            continue
-
-                        # Extract slice where company mention occurs and highlight it
-                        slice_text = org_mention(org.text, article)
-                        h_slice_text = highlight(slice_text, org.text)
+                        # Extract slice around the first occurrence of the company mention and highlight it
+                        raw_slice, begin_slice = org_mention(article, org.start_char)
+                        slice_text = f"...{raw_slice}..."
+                        h_slice_text = f"...{highlight_spans(raw_slice, spans[org.text], begin_slice)}..."
 
                         # Combine all text elements into article text to be displayed during annotation
                         displayed_text = f"<b>Inleiding</b>\n{h_intro}\n\n{h_slice_text}"
@@ -174,6 +194,8 @@ def prodigy_input():
             if mult_cand_flag:
                 mult_cand_articles += 1
 
+    progress.close(samples=counter)
+
     # Print statistics
     print()
     print(f"Saved {counter} companies from {article_count} articles for annotating.")
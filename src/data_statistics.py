@@ -1,4 +1,6 @@
 from utils import *
+from dedup import load_clusters, cluster_sizes
+from progress import Progress
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
@@ -9,24 +11,33 @@ from spacy.kb import KnowledgeBase
 import seaborn as sns
 
 
-def count_mentions(articles, nlp):
-    """Function to count the number of organization mentions in the news articles"""
+def count_mentions(articles, nlp, clusters=None):
+    """
+    Function to count the number of organization mentions in the news articles
+
+    When the near-duplicate clusters are given, only the representative of each cluster is processed
+    and its counts are added once for every article in the cluster.
+    """
 
     # Prepare variables
+    sizes = cluster_sizes(clusters) if clusters is not None else None
     n_articles = 0
     n_mentions = 0
     n_org_articles = 0
     n_org_mentions = 0
 
     i = 0
+    progress = Progress('count_mentions', total=len(articles), unit='articles')
 
     # Go through all news articles
     for article in articles:
         i += 1
+        progress.update(org_mentions=n_org_mentions)
 
-        # Pring progress
-        if i%100 == 0:
-            print(f"{i} articles counted.")
+        # Near-duplicates have the same entities as their representative
+        weight = sizes[i - 1] if sizes is not None else 1
+        if not weight:
+            continue
 
         # Transform article to spaCy doc
         doc = nlp(article)
@@ -34,14 +45,16 @@ def count_mentions(articles, nlp):
         # Count all unique named entities
         entities = set([ent.text for ent in doc.ents])
         if entities:
-            n_mentions += len(entities)
-            n_articles += 1
+            n_mentions += len(entities) * weight
+            n_articles += weight
 
         # Count all unique organizations
         org_entities = set([ent.text for ent in doc.ents if ent.label_ in ['ORG', 'NORP']])
         if org_entities:
-            n_org_mentions += len(org_entities)
-            n_org_articles += 1
+            n_org_mentions += len(org_entities) * weight
+            n_org_articles += weight
+
+    progress.close(org_mentions=n_org_mentions)
 
     # Print statistics
     print(f"{i} articles in total.")
@@ -52,8 +65,8 @@ def count_mentions(articles, nlp):
 def get_statistics():
     """Function to load data and execute the count mentions function"""
     nlp = spacy.load('../resources/nen_nlp')
-    news = pd.read_csv('../data/model_data/prepro_news.tsv', sep='\t')
-    count_mentions(news['full_text'], nlp)
+    news = load_news(columns=['full_text'])
+    count_mentions(news['full_text'], nlp, load_clusters(news['full_text']))
 
 
 def get_distribution():
@@ -1,114 +1,377 @@
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import scan
 import pandas as pd
+import glob
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+COMPANIES_INDEX = "nen-pilot-companies"
+NEWS_INDEX = "nen-pilot-news"
 
-def scrape_companies(es):
-    """Function to scrape KvK numbers and additional information from companies"""
+# Do not exlude any queries
+COMPANIES_QUERY = {"query": {"match_all": {}}}
 
-    # Prepare variables
-    es_index = "nen-pilot-companies"
-    nen_companies = []
-
-    # Do not exlude any queries
-    es_query = {"query": {"match_all": {}}}
-
-    # Save every company entry from the scrape in a list
-    for hit in scan(es, index=es_index, query=es_query):
-        nen_companies.append(hit['_source'])
+def news_query(gte=None, lte=None, exclude_ids=None, gt=None):
+    """
+    Creates the query for scraping the news articles
 
-    # Transform result in pandas DataFrame
-    nen_companies = pd.DataFrame(nen_companies)
-    print(f"Scraped {len(nen_companies)} companies")
+    :param gte: only take articles published at or after this date
+    :param lte: only take articles published at or before this date
+    :param gt: only take articles published after this date
+    :param exclude_ids: ids of documents to leave out, such as those already harvested
+    :return: the Elasticsearch query
+    """
 
-    return nen_companies
+    filters = [
+        {
+            "match_all": {}
+        },
+        {
+            "exists": {
+                # Take news articles that include organizations
+                "field": "resolved_orgs.keyword"
+            }
+        },
+        {
+            "exists": {
+                # Make sure the full text of the article is available
+                "field": "full_text",
+            }
+        },
+        {   # Make sure the title of the article is available
+            "exists": {
+                "field": "title",
+            }
+        },
+        {
+            "match_phrase": {
+                "language.keyword": {
 
+                    # Take only Dutch articles
+                    "query": "nl"
+                }
+            }
+        }
+    ]
 
-def scrape_news(es):
-    """Function to scrape news articles and metadata"""
+    # Take only articles from the given period
+    date_range = {"format": "strict_date_optional_time"}
+    if gte:
+        date_range["gte"] = gte
+    if lte:
+        date_range["lte"] = lte
+    if gt:
+        date_range["gt"] = gt
+    if gte or lte or gt:
+        filters.append({"range": {"publish_date": date_range}})
 
-    # Prepare variables
-    es_index = "nen-pilot-news"
-    nen_news = []
+    must_not = []
+    if exclude_ids:
+        must_not.append({"ids": {"values": list(exclude_ids)}})
 
-    # Specify query for scraping the news articles
-    es_query = {"query": {
+    return {"query": {
         "bool": {
             "must": [],
-            "filter": [
-                {
-                    "match_all": {}
-                },
-                {
-                    "exists": {
-                        # Take news articles that include organizations
-                        "field": "resolved_orgs.keyword"
-                    }
-                },
-                {
-                    "exists": {
-                        # Make sure the full text of the article is available
-                        "field": "full_text",
-                    }
-                },
-                {   # Make sure the title of the article is available
-                    "exists": {
-                        "field": "title",
-                    }
-                },
-                {
-                    "match_phrase": {
-                        "language.keyword": {
-
-                            # Take only Dutch articles
-                            "query": "nl"
-                        }
-                    }
-                },
-                {
-                    "range": {
-                        "publish_date": {
-
-                            # Take only recent articles
-                            "format": "strict_date_optional_time",
-                            "gte": "2021-01-06T16:16:38.151Z",
-                            "lte": "2021-04-06T15:16:38.151Z"
-                        }
-                    }
-                }
-            ],
+            "filter": filters,
             "should": [],
-            "must_not": []
+            "must_not": must_not
         }}}
 
-    # Add all relevant news articles to list
-    for hit in scan(es, index=es_index, query=es_query):
-        nen_news.append(hit['_source'])
 
-    # Transform list into pandas DataFrame
-    nen_news = pd.DataFrame(nen_news)
-    print(f"Scraped {nen_news.shape[0]} news articles")
+# Specify query for scraping the news articles, take only recent articles
+NEWS_QUERY = news_query(gte="2021-01-06T16:16:38.151Z", lte="2021-04-06T15:16:38.151Z")
 
-    return nen_news
 
+def hit_record(hit):
+    """Returns the fields of a hit with its document id, so later harvests can recognise the document"""
 
-def main():
-    # Set up Elastic Search
-    es = Elasticsearch(
+    return dict(hit['_source'], _id=hit['_id'])
+
+
+def write_chunk(hits, out_dir, slice_id, chunk_id):
+    """Writes a chunk of hits to a JSON lines file, which only appears once it is complete"""
+
+    path = os.path.join(out_dir, f"part-{slice_id:03d}-{chunk_id:05d}.jsonl")
+    with open(path + '.tmp', 'w', encoding='utf8') as outfile:
+        for hit in hits:
+            outfile.write(json.dumps(hit_record(hit), ensure_ascii=False) + '\n')
+    os.replace(path + '.tmp', path)
+
+
+def scrape_to_chunks(es, es_index, es_query, out_dir, n_slices=4, chunk_size=10000, scan_fn=scan, report_every=10):
+    """
+    Scrapes an index with parallel sliced scrolls and streams the hits to chunked JSON lines files
+
+    :param es: the Elasticsearch client
+    :param es_index: the index to scrape
+    :param es_query: the query, as used for a single scroll
+    :param out_dir: the directory to save the chunks in
+    :param n_slices: the number of slices that are scrolled in parallel
+    :param chunk_size: the number of hits per chunk file
+    :param scan_fn: the scan implementation, can be replaced by a fake for testing
+    :param report_every: the number of seconds between progress reports
+    :return: the number of scraped documents
+    """
+
+    # Prepare variables, and remove the chunks of an earlier scrape
+    os.makedirs(out_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(out_dir, 'part-*.jsonl')):
+        os.remove(path)
+    counts = [0] * n_slices
+    done = threading.Event()
+    start = time.perf_counter()
+
+    def scroll_slice(slice_id):
+        """Scrolls through one slice of the index and writes its hits in chunks"""
+
+        # Elasticsearch only accepts a slice when there are at least two
+        query = dict(es_query)
+        if n_slices > 1:
+            query['slice'] = {'id': slice_id, 'max': n_slices}
+
+        chunk = []
+        chunk_id = 0
+        for hit in scan_fn(es, index=es_index, query=query):
+            chunk.append(hit)
+            counts[slice_id] += 1
+            if len(chunk) == chunk_size:
+                write_chunk(chunk, out_dir, slice_id, chunk_id)
+                chunk = []
+                chunk_id += 1
+
+        if chunk:
+            write_chunk(chunk, out_dir, slice_id, chunk_id)
+
+    def report_progress():
+        """Prints the number of scraped documents and the scraping speed until all slices are done"""
+
+        while not done.wait(report_every):
+            n_docs = sum(counts)
+            print(f"{n_docs} documents scraped from {es_index} ({n_docs / (time.perf_counter() - start):.1f} docs/sec).")
+
+    reporter = threading.Thread(target=report_progress, daemon=True)
+    reporter.start()
+
+    # Scroll all slices in parallel, waiting on Elasticsearch and disk does not hold the GIL
+    try:
+        with ThreadPoolExecutor(max_workers=n_slices) as executor:
+            for future in [executor.submit(scroll_slice, slice_id) for slice_id in range(n_slices)]:
+                future.result()
+    finally:
+        done.set()
+
+    n_docs = sum(counts)
+    elapsed = time.perf_counter() - start
+    print(f"Scraped {n_docs} documents from {es_index} in {elapsed:.1f} seconds ({n_docs / max(elapsed, 1e-9):.1f} docs/sec).")
+
+    return n_docs
+
+
+def chunk_columns(paths):
+    """Returns the union of the fields in the chunk files, in the order they first appear"""
+
+    columns = dict()
+    for path in paths:
+        with open(path, 'r', encoding='utf8') as infile:
+            for line in infile:
+                if line.strip():
+                    columns.update(dict.fromkeys(json.loads(line)))
+
+    return list(columns)
+
+
+def chunks_to_tsv(chunk_dir, tsv_path):
+    """
+    Combines the chunk files into one .tsv file, one chunk at a time
+
+    The columns are the union of the fields of all chunks, collected in a first pass over the chunks,
+    so every chunk is written with the same columns.
+    """
+
+    paths = sorted(glob.glob(os.path.join(chunk_dir, 'part-*.jsonl')))
+    columns = chunk_columns(paths)
+    n_rows = 0
+    for path in paths:
+        chunk = pd.read_json(path, lines=True, dtype=False)
+
+        # Continue the index over the chunks, as if the file was written at once
+        chunk = chunk.reindex(columns=columns)
+        chunk.index = range(n_rows, n_rows + len(chunk))
+        chunk.to_csv(tsv_path, sep='\t', mode='w' if n_rows == 0 else 'a', header=n_rows == 0)
+        n_rows += len(chunk)
+
+    return n_rows
+
+
+def load_harvest_state(state_path, corpus_path):
+    """Loads the high-water mark of earlier harvests, the latest publish_date and the ids published at it"""
+
+    if os.path.exists(state_path):
+        with open(state_path, 'r', encoding='utf8') as infile:
+            return json.load(infile)
+
+    state = {'publish_date': None, 'ids': [], 'n_rows': 0}
+    if not os.path.exists(corpus_path):
+        return state
+
+    # Start from the latest article of a corpus that was scraped before harvesting, and keep the ids of
+    # the articles published at that moment, so the next harvest does not fetch them again
+    has_ids = '_id' in pd.read_csv(corpus_path, sep='\t', nrows=0).columns
+    usecols = ['publish_date', '_id'] if has_ids else ['publish_date']
+    latest_date = None
+    latest_ids = set()
+    for chunk in pd.read_csv(corpus_path, sep='\t', usecols=usecols, chunksize=100000):
+        state['n_rows'] += len(chunk)
+        dates = pd.to_datetime(chunk['publish_date'])
+        if dates.isna().all():
+            continue
+
+        chunk_latest = dates.max()
+        if latest_date is None or chunk_latest > latest_date:
+            latest_date = chunk_latest
+            latest_ids = set()
+        if chunk_latest == latest_date and has_ids:
+            latest_ids.update(chunk.loc[dates == chunk_latest, '_id'])
+
+    if latest_date is not None:
+        state['publish_date'] = latest_date.isoformat()
+
+    # Without document ids, the articles at the latest date are left out by fetching strictly later articles
+    state['ids'] = sorted(latest_ids) if has_ids else None
+
+    return state
+
+
+def save_harvest_state(state, state_path):
+    """Saves the high-water mark, replacing the old state only once the new one is written"""
+
+    with open(state_path + '.tmp', 'w', encoding='utf8') as outfile:
+        json.dump(state, outfile)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def harvest_news(es, corpus_path, delta_path, state_path, chunk_size=10000, scan_fn=scan):
+    """
+    Fetches only the news articles published since the last harvest
+
+    New articles are appended to the corpus and written to a separate delta file, that can be
+    handed to preprocessing and candidate discovery.
+
+    :param es: the Elasticsearch client
+    :param corpus_path: the .tsv file with all news articles
+    :param delta_path: the .tsv file to save the new articles in
+    :param state_path: the .json file with the high-water mark
+    :param chunk_size: the number of articles that are written at once
+    :param scan_fn: the scan implementation, can be replaced by a fake for testing
+    :return: the number of new articles
+    """
+
+    # Fetch articles from the last seen publish_date on, leaving out the ones already seen at that date
+    state = load_harvest_state(state_path, corpus_path)
+    if state['ids'] is None:
+        es_query = news_query(gt=state['publish_date'])
+    else:
+        es_query = news_query(gte=state['publish_date'], exclude_ids=state['ids'])
+
+    # Keep the columns of the existing corpus
+    columns = None
+    if os.path.exists(corpus_path):
+        columns = list(pd.read_csv(corpus_path, sep='\t', index_col=0, nrows=0).columns)
+
+    # Prepare variables
+    latest_date = pd.Timestamp(state['publish_date']) if state['publish_date'] else None
+    latest_ids = set(state['ids'] or [])
+    n_rows = state['n_rows']
+    n_new = 0
+    chunk = []
+
+    def write(chunk):
+        """Appends a chunk of articles to the corpus and to the delta file"""
+
+        nonlocal columns, n_rows, n_new
+        chunk = pd.DataFrame(chunk)
+        if columns is None:
+            columns = list(chunk.columns)
+
+        # Continue the index of the corpus
+        chunk = chunk.reindex(columns=columns)
+        chunk.index = range(n_rows, n_rows + len(chunk))
+        chunk.to_csv(corpus_path, sep='\t', mode='a', header=not os.path.exists(corpus_path))
+        chunk.to_csv(delta_path, sep='\t', mode='w' if n_new == 0 else 'a', header=n_new == 0)
+        n_rows += len(chunk)
+        n_new += len(chunk)
+
+    for hit in scan_fn(es, index=NEWS_INDEX, query=es_query):
+        chunk.append(hit_record(hit))
+
+        # Track the latest publish_date and the documents published at that moment
+        publish_date = pd.Timestamp(hit['_source']['publish_date'])
+        if latest_date is None or publish_date > latest_date:
+            latest_date = publish_date
+            latest_ids = {hit['_id']}
+        elif publish_date == latest_date:
+            latest_ids.add(hit['_id'])
+
+        if len(chunk) == chunk_size:
+            write(chunk)
+            chunk = []
+
+    if chunk:
+        write(chunk)
+
+    # Always write the delta file, even without new articles, so the delta of an earlier harvest is not used
+    if n_new == 0:
+        pd.DataFrame(columns=columns or []).to_csv(delta_path, sep='\t')
+
+    # Only move the high-water mark once all new articles are saved
+    if n_new:
+        save_harvest_state({'publish_date': latest_date.isoformat(), 'ids': sorted(latest_ids), 'n_rows': n_rows},
+                           state_path)
+    print(f"Harvested {n_new} new news articles, {n_rows} articles in total.")
+
+    return n_new
+
+
+def get_client():
+    """Sets up the Elastic Search client"""
+
+    return Elasticsearch(
         ["https://search.brainial.com/"],
         http_auth=("esuser", "ww_2020@12"),
         scheme="https",
         port=443,
     )
 
+
+def main():
+    es = get_client()
+
     # Scrape company information and save it as a tsv file
-    nen_companies = scrape_companies(es)
-    nen_companies.to_csv('../../data/model_data/nen_companies.tsv', sep='\t')
+    scrape_to_chunks(es, COMPANIES_INDEX, COMPANIES_QUERY, '../../data/model_data/nen_companies_chunks')
+    chunks_to_tsv('../../data/model_data/nen_companies_chunks', '../../data/model_data/nen_companies.tsv')
 
     # Scrape news articles and save them as a tsv file
-    nen_news = scrape_news(es)
-    nen_news.to_csv('../../data/model_data/nen_news.tsv', sep='\t')
+    scrape_to_chunks(es, NEWS_INDEX, NEWS_QUERY, '../../data/model_data/nen_news_chunks')
+    chunks_to_tsv('../../data/model_data/nen_news_chunks', '../../data/model_data/nen_news.tsv')
+
+
+def harvest():
+    """Daily harvest: fetches the news articles published since the last harvest"""
+
+    es = get_client()
+
+    harvest_news(es,
+                 '../../data/model_data/nen_news.tsv',
+                 '../../data/model_data/nen_news_delta.tsv',
+                 '../../data/model_data/harvest_state.json')
 
 
 if __name__ == '__main__':
-    main()
+    if '--harvest' in sys.argv:
+        harvest()
+    else:
+        main()
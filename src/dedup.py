@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import zlib
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from utils import load_news
+
+# Mersenne prime for the universal hash functions, products with 31-bit numbers fit in 64 bits
+PRIME = (1 << 31) - 1
+
+
+def shingles(text, k=5):
+    """Returns the hashes of the word k-shingles of a text"""
+
+    words = str(text).lower().split()
+    if len(words) <= k:
+        return np.array([zlib.crc32(' '.join(words).encode('utf8'))], dtype=np.uint64)
+
+    return np.array([zlib.crc32(' '.join(words[i:i + k]).encode('utf8')) for i in range(len(words) - k + 1)],
+                    dtype=np.uint64)
+
+
+def minhash_signatures(texts, num_perm=64, k=5, seed=1):
+    """
+    Computes a MinHash signature for each text
+
+    :param texts: the texts to compute the signatures of
+    :param num_perm: the number of hash functions, the length of each signature
+    :param k: the number of words per shingle
+    :param seed: the seed for drawing the hash functions
+    :return: matrix with one signature per text
+    :rtype: numpy.ndarray
+    """
+
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, PRIME, size=(num_perm, 1)).astype(np.uint64)
+    b = rng.randint(0, PRIME, size=(num_perm, 1)).astype(np.uint64)
+
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint64)
+    for n, text in enumerate(texts):
+        hashes = shingles(text, k) % PRIME
+        signatures[n] = ((a * hashes + b) % PRIME).min(axis=1)
+
+    return signatures
+
+
+def cluster_duplicates(signatures, bands=16, threshold=0.8):
+    """
+    Clusters near-duplicate texts with locality-sensitive hashing on their MinHash signatures
+
+    :param signatures: the MinHash signatures of the texts
+    :param bands: the number of LSH bands, texts that agree on a whole band are compared
+    :param threshold: the minimal estimated Jaccard similarity of near-duplicates
+    :return: for each text the index of the representative of its cluster, its first member
+    :rtype: numpy.ndarray
+    """
+
+    n_texts, num_perm = signatures.shape
+    rows = num_perm // bands
+    parent = np.arange(n_texts)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # Texts that share a bucket in any band are candidate near-duplicates
+    for band in range(bands):
+        buckets = defaultdict(list)
+        for n, key in enumerate(signatures[:, band * rows:(band + 1) * rows]):
+            buckets[key.tobytes()].append(n)
+
+        for members in buckets.values():
+            first = members[0]
+            for other in members[1:]:
+                root_first, root_other = find(first), find(other)
+                if root_first == root_other:
+                    continue
+
+                # Only merge texts whose estimated Jaccard similarity is high enough
+                if np.mean(signatures[first] == signatures[other]) >= threshold:
+                    parent[max(root_first, root_other)] = min(root_first, root_other)
+
+    return np.array([find(i) for i in range(n_texts)])
+
+
+def dedup_report(texts, clusters):
+    """Prints how many articles are near-duplicates and how much NER work is saved by skipping them"""
+
+    n_texts = len(clusters)
+    representatives = clusters == np.arange(n_texts)
+    lengths = np.array([len(text) for text in texts])
+    saved_chars = lengths[~representatives].sum()
+
+    print(f"{n_texts - representatives.sum()} of {n_texts} articles are near-duplicates, "
+          f"in {len(set(clusters[~representatives]))} clusters.")
+    print(f"NER runs on {representatives.sum()} representatives, saving "
+          f"{(n_texts - representatives.sum()) / max(n_texts, 1):.1%} of the articles and "
+          f"{saved_chars / max(lengths.sum(), 1):.1%} of the characters.")
+
+
+def texts_fingerprint(texts):
+    """Returns a content hash of the news texts, in their order"""
+
+    digest = hashlib.blake2b(digest_size=16)
+    for text in texts:
+        digest.update(str(text).encode('utf8'))
+        digest.update(b'\x00')
+
+    return digest.hexdigest()
+
+
+def meta_path(clusters_loc):
+    """Returns the path of the file with the fingerprint of the news the clusters were computed on"""
+
+    return os.path.splitext(clusters_loc)[0] + '.json'
+
+
+def save_clusters(texts, clusters, clusters_loc='../data/model_data/news_clusters.tsv'):
+    """Saves the representative of each article, with a fingerprint of the news texts"""
+
+    pd.DataFrame({'cluster': clusters}).to_csv(clusters_loc, sep='\t', index=False)
+    with open(meta_path(clusters_loc), 'w') as outfile:
+        json.dump({'n_articles': len(clusters), 'fingerprint': texts_fingerprint(texts)}, outfile)
+
+
+def load_clusters(texts, clusters_loc='../data/model_data/news_clusters.tsv'):
+    """
+    Loads the cluster representative of each news article
+
+    The clusters are only used for the news they were computed on. When the news texts changed, for
+    example after preprocessing again or appending a delta, the clusters are computed again and saved.
+
+    :param texts: the full texts of the news articles, in the order of the news data
+    :param clusters_loc: the .tsv file saved by this module
+    :return: the representative of each article, or None if the news was never deduplicated
+    """
+
+    if not os.path.exists(clusters_loc):
+        return None
+
+    texts = list(texts)
+    meta = None
+    if os.path.exists(meta_path(clusters_loc)):
+        with open(meta_path(clusters_loc)) as infile:
+            meta = json.load(infile)
+
+    if meta is not None and meta['n_articles'] == len(texts) and meta['fingerprint'] == texts_fingerprint(texts):
+        return pd.read_csv(clusters_loc, sep='\t')['cluster'].to_numpy()
+
+    print(f"{clusters_loc} does not match the {len(texts)} news articles, clustering them again.")
+    clusters = cluster_duplicates(minhash_signatures(texts))
+    save_clusters(texts, clusters, clusters_loc)
+
+    return clusters
+
+
+def cluster_sizes(clusters):
+    """Returns for each article the number of articles its cluster represents, 0 for non-representatives"""
+
+    return np.bincount(clusters, minlength=len(clusters))
+
+
+def main():
+    # Cluster near-duplicate articles and save the representative of each article
+    news = load_news(columns=['full_text'])
+    texts = list(news['full_text'])
+    clusters = cluster_duplicates(minhash_signatures(texts))
+    save_clusters(texts, clusters)
+    dedup_report(texts, clusters)
+
+
+if __name__ == '__main__':
+    main()
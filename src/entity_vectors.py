@@ -0,0 +1,320 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+DTYPES = ['float32', 'float16', 'int8']
+
+
+def quantise(vectors, dtype):
+    """
+    Quantises a matrix of float32 vectors
+
+    float16 halves the memory of the vectors, int8 quarters it: every vector is scaled so its largest
+    absolute value becomes 127 and rounded, and the scale is kept to restore it.
+
+    :param vectors: the float32 vectors, one per row
+    :param dtype: 'float32', 'float16' or 'int8'
+    :return: the quantised vectors and the scale of each vector
+    """
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.ones(len(vectors), dtype=np.float32)
+
+    if dtype == 'float32':
+        return vectors, scales
+    if dtype == 'float16':
+        return vectors.astype(np.float16), scales
+    if dtype == 'int8':
+        if len(vectors):
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+        quantised = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return quantised, scales.astype(np.float32)
+
+    raise ValueError(f"Unknown vector type: {dtype}")
+
+
+class EntityVectors:
+    """
+    Stores the entity vectors of the Knowledge Base once per unique vector
+
+    Most companies share their SBI-code description, and so their vector. The store keeps every distinct
+    vector once, optionally quantised, and a row into those vectors per entity, so its memory grows with
+    the number of unique descriptions instead of the number of companies. The entities are sorted, so
+    an entity is found with a binary search and the arrays can be memory-mapped as they are saved.
+    """
+
+    def __init__(self, entities, rows, vectors, scales):
+        """
+        :param entities: the sorted KvK-numbers, as a numpy string array
+        :param rows: the row in `vectors` of each entity
+        :param vectors: the unique vectors, float32, float16 or int8
+        :param scales: the scale of each unique vector, all ones unless the vectors are int8
+        """
+
+        self.entities = entities
+        self.rows = rows
+        self.vectors = vectors
+        self.scales = scales
+
+    @classmethod
+    def from_vectors(cls, entities, vectors, dtype='float32'):
+        """
+        Builds the store from one vector per entity, identical vectors are stored once
+
+        :param entities: the KvK-numbers
+        :param vectors: the float32 vector of each entity
+        :param dtype: the type to store the unique vectors in, 'float32', 'float16' or 'int8'
+        :return: the store
+        """
+
+        entities = np.array([str(entity) for entity in entities])
+        order = np.argsort(entities, kind='stable')
+
+        unique = dict()
+        rows = np.empty(len(entities), dtype=np.int32)
+        unique_vectors = []
+        for position, n in enumerate(order):
+            vector = np.asarray(vectors[n], dtype=np.float32)
+            key = vector.tobytes()
+            if key not in unique:
+                unique[key] = len(unique_vectors)
+                unique_vectors.append(vector)
+            rows[position] = unique[key]
+
+        length = len(unique_vectors[0]) if unique_vectors else 0
+        matrix = np.array(unique_vectors, dtype=np.float32).reshape(len(unique_vectors), length)
+        quantised, scales = quantise(matrix, dtype)
+
+        return cls(entities[order], rows, quantised, scales)
+
+    @classmethod
+    def from_descriptions(cls, desc_dict, nlp, dtype='float32'):
+        """
+        Encodes the SBI-code description of every company, each unique description only once
+
+        :param desc_dict: dict with KvK-numbers and SBI-code descriptions of companies
+        :param nlp: the nlp object to retrieve the vector of an SBI-code description
+        :param dtype: the type to store the unique vectors in
+        :return: the store
+        """
+
+        from utils import get_vectors
+
+        return cls.from_vectors(list(desc_dict), get_vectors(list(desc_dict.values()), nlp), dtype)
+
+    @classmethod
+    def from_kb(cls, kb, dtype='float32'):
+        """Builds the store from the entity vectors in a spaCy Knowledge Base"""
+
+        entities = list(kb.get_entity_strings())
+
+        return cls.from_vectors(entities, [kb.get_vector(entity) for entity in entities], dtype)
+
+    def row(self, entity):
+        """Returns the row of the vector of an entity, or -1 if the entity is not stored"""
+
+        entity = str(entity)
+        position = int(np.searchsorted(self.entities, entity))
+        if position < len(self.entities) and self.entities[position] == entity:
+            return int(self.rows[position])
+
+        return -1
+
+    def vector(self, row):
+        """Returns the float32 vector of a row"""
+
+        return self.vectors[row].astype(np.float32) * self.scales[row]
+
+    def get(self, entity):
+        """
+        Returns the float32 vector of an entity
+
+        :param entity: the KvK-number
+        :return: the vector, restored from its quantised form, or None if the entity is not stored
+        """
+
+        row = self.row(entity)
+        if row < 0:
+            return None
+
+        return self.vector(row)
+
+    def matrix(self, entities):
+        """Returns the float32 vectors of several entities as one matrix"""
+
+        rows = [self.row(entity) for entity in entities]
+        if min(rows, default=0) < 0:
+            missing = [entity for entity, row in zip(entities, rows) if row < 0]
+            raise KeyError(f"No vector for entities: {missing[:5]}")
+
+        return self.vectors[rows].astype(np.float32) * self.scales[rows, None]
+
+    def __contains__(self, entity):
+        return self.row(entity) >= 0
+
+    def __len__(self):
+        return len(self.entities)
+
+    @property
+    def n_unique(self):
+        return len(self.vectors)
+
+    @property
+    def dtype(self):
+        return self.vectors.dtype.name
+
+    @property
+    def nbytes(self):
+        """The memory of the vectors and the entity rows, the entity ids are left out"""
+
+        return self.vectors.nbytes + self.scales.nbytes + self.rows.nbytes
+
+    def save(self, path):
+        """Saves the arrays as .npy files in a directory"""
+
+        os.makedirs(path, exist_ok=True)
+        for name in ['entities', 'rows', 'vectors', 'scales']:
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Loads a saved store, by default memory-mapped so processes share one copy in the page cache"""
+
+        arrays = [np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+                  for name in ['entities', 'rows', 'vectors', 'scales']]
+
+        return cls(*arrays)
+
+
+def rebuild_kb(kb, store, nlp):
+    """
+    Creates a copy of a Knowledge Base with the entity vectors taken from the store
+
+    The aliases, candidates and prior probabilities stay the same, so the effect of quantising the
+    vectors can be measured with the trained Entity Linker.
+
+    :param kb: the Knowledge Base to copy
+    :param store: the entity vector store
+    :param nlp: the nlp object whose vocab the new Knowledge Base uses
+    :return: the new Knowledge Base
+    """
+
+    from spacy.kb import KnowledgeBase
+
+    entities = list(kb.get_entity_strings())
+    freqs = dict()
+    aliases = []
+    for alias in kb.get_alias_strings():
+        candidates = kb.get_candidates(alias)
+        for c in candidates:
+            freqs[c.entity_] = c.entity_freq
+        aliases.append((alias, [c.entity_ for c in candidates], [c.prior_prob for c in candidates]))
+
+    new_kb = KnowledgeBase(vocab=nlp.vocab, entity_vector_length=kb.entity_vector_length)
+    new_kb.set_entities(entity_list=entities,
+                        freq_list=[freqs.get(entity, 1) for entity in entities],
+                        vector_list=list(store.matrix(entities)))
+    for alias, candidates, prior_probs in aliases:
+        new_kb.add_alias(alias=alias, entities=candidates, probabilities=prior_probs)
+
+    return new_kb
+
+
+def measure_quantisation(dtypes=DTYPES, test_loc="../data/model_data/test_data.tsv"):
+    """
+    Measures the memory and the accuracy of the Entity Linker on the test data for each vector type
+
+    The trained Entity Linker gets a copy of its Knowledge Base with the vectors restored from each
+    quantised store. Predictions are compared to the gold labels and to those with the float32 vectors.
+
+    :param dtypes: the vector types to measure
+    :param test_loc: the annotated test data
+    :return: list with a result dict per vector type
+    """
+
+    import spacy
+    from spacy.kb import KnowledgeBase
+    import sklearn.metrics as sk
+    from evaluation import MODEL_LOC, KB_LOC, preprocess, system_predictions
+
+    gold_labels, test_data = preprocess(test_loc)
+    nlp = spacy.load(MODEL_LOC)
+    kb = KnowledgeBase(vocab=nlp.vocab, entity_vector_length=96)
+    kb.load_bulk(KB_LOC)
+
+    entities = list(kb.get_entity_strings())
+    original = np.array([kb.get_vector(entity) for entity in entities], dtype=np.float32)
+    linker = nlp.get_pipe('entity_linker')
+    dense_bytes = original.nbytes
+
+    results = []
+    reference = None
+    for dtype in dtypes:
+        store = EntityVectors.from_vectors(entities, original, dtype)
+        restored = store.matrix(entities)
+
+        linker.set_kb(rebuild_kb(kb, store, nlp))
+        predictions = system_predictions(test_data, nlp)
+        if reference is None:
+            reference = predictions
+
+        report = sk.classification_report(gold_labels, predictions, output_dict=True, zero_division=False)
+        results.append({'dtype': dtype,
+                        'entities': len(store),
+                        'unique_vectors': store.n_unique,
+                        'bytes': store.nbytes,
+                        'dense_float32_bytes': dense_bytes,
+                        'max_abs_error': float(np.abs(restored - original).max()) if len(original) else 0.0,
+                        'accuracy': sk.accuracy_score(gold_labels, predictions),
+                        'weighted_f1': report['weighted avg']['f1-score'],
+                        'changed_predictions': sum(a != b for a, b in zip(predictions, reference))})
+
+    return results
+
+
+def print_results(results):
+    print(f"{'dtype':<8} {'unique':>8} {'MB':>10} {'dense MB':>10} {'max error':>10} {'accuracy':>9} "
+          f"{'F1':>7} {'changed':>8}")
+    for result in results:
+        print(f"{result['dtype']:<8} {result['unique_vectors']:>8} {result['bytes'] / 1e6:>10.2f} "
+              f"{result['dense_float32_bytes'] / 1e6:>10.2f} {result['max_abs_error']:>10.5f} "
+              f"{result['accuracy']:>9.3f} {result['weighted_f1']:>7.3f} {result['changed_predictions']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Saves the entity vectors of a KB as a compact store, or measures "
+                                                 "the effect of quantising them on the test data.")
+    parser.add_argument('--kb', default='../resources/kb_initial')
+    parser.add_argument('--nlp', default='../resources/nen_nlp')
+    parser.add_argument('--dtype', choices=DTYPES, default='float16')
+    parser.add_argument('--output', default='../resources/entity_vectors')
+    parser.add_argument('--measure', action='store_true',
+                        help="Measure memory and accuracy of every vector type with the trained Entity Linker")
+    parser.add_argument('--report', default='../data/model_data/entity_vectors.json')
+    args = parser.parse_args()
+
+    if args.measure:
+        results = measure_quantisation()
+        print_results(results)
+        with open(args.report, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+        return
+
+    import spacy
+    from spacy.kb import KnowledgeBase
+
+    nlp = spacy.load(args.nlp)
+    kb = KnowledgeBase(vocab=nlp.vocab, entity_vector_length=96)
+    kb.load_bulk(args.kb)
+
+    store = EntityVectors.from_kb(kb, args.dtype)
+    store.save(args.output)
+    print(f"Saved {store.n_unique} unique {store.dtype} vectors for {len(store)} entities in {args.output} "
+          f"({store.nbytes / 1e6:.2f} MB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,19 @@
+import hashlib
+import json
 import pickle
 import spacy
+from concurrent.futures import ProcessPoolExecutor
 from utils import *
 import pandas as pd
 from sklearn.feature_extraction.text import TfidfVectorizer
 import sklearn.metrics as sk
-from spacy.kb import KnowledgeBase
+from metrics import bootstrap_report
+import metrics
+import utils
+import kb_snapshot
+from progress import Progress
+from kb_snapshot import load_kb
+from prediction_cache import PredictionCache, fingerprint_path, fingerprint_source, combine_fingerprints, row_key
 
 
 def majority_baseline(test_data, kb):
@@ -33,36 +42,38 @@ def majority_baseline(test_data, kb):
     return predictions
 
 
-def system_predictions(test_data):
+def system_predictions(test_data, nlp, batch_size=16):
     """Get predictions on the test set from the trained model"""
 
-    # Load resources and prepare variables
-    nlp = spacy.load('resources/nen_nlp_el_sentence')
-    predictions = []
-    i = 0
+    # Parse each unique article only once, articles can contain multiple company mentions
+    articles = list(dict.fromkeys(text for text, small_context, offset in test_data))
+    entity_index = dict()
+    for text, doc in zip(articles, nlp.pipe(articles, batch_size=batch_size)):
+
+        # Index the linked Named Entities by their offsets, and by their text for the first occurrence
+        offsets = dict()
+        texts = dict()
+        for ent in doc.ents:
+            offsets[(ent.start_char, ent.end_char)] = ent.kb_id_
+            texts.setdefault(ent.text, ent.kb_id_)
+        entity_index[text] = (offsets, texts)
 
     # Go through all test data samples
+    predictions = []
     for text, small_context, offset in test_data:
-        i += 1
-
-        # Make spaCy doc object from test data sample
-        doc = nlp(text)
+        offsets, texts = entity_index[text]
 
         # Extract org from text
         org = text[offset[0]:offset[1]]
-        flag = False
 
-        # Go through all Named Entities in the article
-        for ent in doc.ents:
-
-            # If entity
-            if ent.text == org:
-                predictions.append(ent.kb_id_)
-                flag = True
-                break
+        # Look up the entity at the gold offsets, or else the first entity with the same text
+        if offset in offsets:
+            predictions.append(offsets[offset])
+        elif org in texts:
+            predictions.append(texts[org])
 
         # Mention is not recognised as Named Entity by spaC'y NER system
-        if flag == False:
+        else:
             predictions.append('NERror')
 
     return predictions
@@ -94,18 +105,18 @@ def get_prediction(org, vectorizer, clean_matrix, companies):
         return None
 
 
-def baseline_predictions(test_data):
-    """Saves predictions of Brainial baseline"""
-
-    # Loads data
-    companies = pd.read_csv('../data/model_data/prepro_companies.tsv', sep='\t')
-    companies['all_names'] = string_to_list(companies['all_names'])
-    companies = companies.explode('all_names')
+def fit_vectorizer(companies):
+    """Fits the TF-IDF n-gram vectorizer on the names of all companies"""
 
-    # Prepare vectorizer
     vectorizer = TfidfVectorizer(min_df=1, analyzer=ngrams_chars, lowercase=False)
     clean_matrix = vectorizer.fit_transform(companies["all_names"])
 
+    return vectorizer, clean_matrix
+
+
+def baseline_predictions(test_data, companies, vectorizer, clean_matrix):
+    """Saves predictions of Brainial baseline"""
+
     predictions = []
 
     # Save the KB entity with the highest name similarity to the company mention
@@ -148,60 +159,66 @@ def get_candidates(org, vectorizer, clean_matrix, companies):
         return None
 
 
-def context_prediction(candidates, text):
+def description_matrix(companies, nlp):
+    """
+    Precomputes the L2-normalised vectors of the SBI-code description and city of every entity
+
+    :param companies: the company database, possibly exploded over company names
+    :param nlp: the nlp object used to encode the descriptions
+    :return: dict mapping KvK-numbers to their row and the matrix of description vectors
+    """
+
+    # Keep one row per entity
+    entities = companies.drop_duplicates(subset='kvk_number')
+    descriptions = [f"{sbi} {city}" for sbi, city in zip(entities['sbi_code_description'], entities['city'])]
+
+    # Encode all descriptions in batches
+    matrix = get_vectors(descriptions, nlp, normalise=True)
+    kvk_rows = {kvk: n for n, kvk in enumerate(entities['kvk_number'])}
+
+    return kvk_rows, matrix
+
+
+def context_prediction(candidates, context_vector, kvk_rows, desc_matrix):
     """Selects candidate for a mention whose description fits the context best"""
 
-    nlp = spacy.load('nl_core_news_lg')
+    if not candidates:
+        return ""
 
-    # Set best candidate to candidate with the highest fuzzy matching similarity
-    #best_candidate = str(best_cand)
-    #best_cand_doc = nlp(candidates[best_cand]['sbi'])
+    # Cosine similarity between the context and the description of each candidate
+    candidate_kvks = list(candidates)
+    similarities = desc_matrix[[kvk_rows[kvk] for kvk in candidate_kvks]] @ context_vector
 
-    # Retrieve doc-object of context
-    context_doc = nlp(text)
-    #highest_sim = best_cand_doc.similarity(context_doc)
-    highest_sim = 0
-    best_candidate = ""
+    # Select the candidate with the highest similarity, only if it is positive
+    best = int(np.argmax(similarities))
+    if similarities[best] <= 0:
+        return ""
 
-    # Compare SBI-description doc to context doc for each candidate
-    for candidate in candidates:
+    return candidate_kvks[best]
 
-        # Get SBI description doc
-        sbi_doc = nlp(candidates[candidate]['sbi'])
 
-        # Compute Cosine similarity between vectors
-        similarity = sbi_doc.similarity(context_doc)
+def load_context_model(companies):
+    """Loads the pipeline used for context comparison and encodes the descriptions of all entities"""
 
-        # Update best candidate/highest similarity variables
-        if similarity > highest_sim:
-            highest_sim = similarity
-            best_candidate = candidate
+    nlp = spacy.load(CONTEXT_MODEL)
+    kvk_rows, desc_matrix = description_matrix(companies, nlp)
 
-    return best_candidate
+    return nlp, kvk_rows, desc_matrix
 
 
-def baseline_context_predictions(test_data):
+def baseline_context_predictions(test_data, companies, vectorizer, clean_matrix, context_model):
     """Get predictions from Brainial baseline with context comparison"""
 
-    # Load data
-    companies = pd.read_csv('../data/model_data/prepro_companies.tsv', sep='\t')
-    companies['all_names'] = string_to_list(companies['all_names'])
-    companies = companies.explode('all_names')
-
-    # Prepare vectorizer
-    vectorizer = TfidfVectorizer(min_df=1, analyzer=ngrams_chars, lowercase=False)
-    clean_matrix = vectorizer.fit_transform(companies["all_names"])
+    # Encode the context of all samples once
+    nlp, kvk_rows, desc_matrix = context_model
+    context_matrix = get_vectors([text for text, small_context, offset in test_data], nlp, normalise=True)
 
     predictions = []
-    i = 0
+    progress = Progress('baseline_context_predictions', total=len(test_data), unit='samples')
 
     # Make prediction for each sample in test data
-    for text, small_context, offset in test_data:
-
-        # Print progress
-        i += 1
-        if i%50 == 0:
-            print(f"{i} samples processed.")
+    for (text, small_context, offset), context_vector in zip(test_data, context_matrix):
+        progress.update()
 
         # Extract company mention
         org = text[offset[0]:offset[1]]
@@ -210,9 +227,11 @@ def baseline_context_predictions(test_data):
         candidates = get_candidates(org, vectorizer, clean_matrix, companies)
 
         # Select candidate whose SBI description matched the context best
-        prediction = context_prediction(candidates, text)
+        prediction = context_prediction(candidates, context_vector, kvk_rows, desc_matrix)
         predictions.append(prediction)
 
+    progress.close()
+
     return predictions
 
 
@@ -244,14 +263,152 @@ def preprocess(test_loc):
     return gold_labels, test_data
 
 
-def evaluate():
+MODEL_LOC = 'resources/nen_nlp_el_sentence'
+KB_LOC = 'resources/kb_probs'
+COMPANIES_LOC = '../data/model_data/prepro_companies.tsv'
+CACHE_LOC = '../data/model_data/prediction_cache.sqlite'
+CONTEXT_MODEL = 'nl_core_news_lg'
+
+
+def linker_predictions(samples):
+    """Get predictions from the trained model and the majority baseline, which share the KB"""
+
+    nlp = spacy.load(MODEL_LOC)
+
+    predictions = dict()
+    if samples.get('el_system'):
+        predictions['el_system'] = system_predictions(samples['el_system'], nlp)
+    if samples.get('majority'):
+        kb = load_kb(KB_LOC, nlp.vocab)
+        predictions['majority'] = majority_baseline(samples['majority'], kb)
+
+    return predictions
+
+
+def name_baseline_predictions(samples, companies, vectorizer, clean_matrix):
+    """Get predictions from the Brainial baseline"""
+
+    return {'baseline': baseline_predictions(samples['baseline'], companies, vectorizer, clean_matrix)}
+
+
+def context_baseline_predictions(samples, companies, vectorizer, clean_matrix):
+    """Get predictions from the Brainial baseline with context comparison"""
+
+    context_model = load_context_model(companies)
+
+    return {'baseline_context': baseline_context_predictions(samples['baseline_context'], companies, vectorizer,
+                                                             clean_matrix, context_model)}
+
+
+def model_fingerprint(name):
+    """Fingerprints an installed spaCy model by its meta data, which holds its name, version and vectors"""
+
+    path = spacy.util.get_package_path(name) if spacy.util.is_package(name) else name
+    meta = spacy.util.get_model_meta(path)
+
+    return hashlib.sha256(json.dumps(meta, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def system_fingerprints():
+    """Fingerprints the models, KB, company data and code each system depends on"""
+
+    model = fingerprint_path(MODEL_LOC)
+    kb = fingerprint_path(KB_LOC)
+    companies = fingerprint_path(table_path(COMPANIES_LOC))
+    context_model = model_fingerprint(CONTEXT_MODEL)
+
+    # The helper modules are hashed as a whole, a change in any of them invalidates the predictions
+    helpers = fingerprint_source(utils, metrics)
+
+    return {'el_system': combine_fingerprints(model, helpers, fingerprint_source(system_predictions)),
+            'majority': combine_fingerprints(kb, helpers, fingerprint_source(majority_baseline, kb_snapshot)),
+            'baseline': combine_fingerprints(companies, helpers, fingerprint_source(
+                fit_vectorizer, baseline_predictions, get_prediction, awesome_cossim_top)),
+            'baseline_context': combine_fingerprints(companies, context_model, helpers, fingerprint_source(
+                fit_vectorizer, get_candidates, load_context_model, description_matrix, context_prediction,
+                baseline_context_predictions))}
+
+
+def run_systems(test_data, n_workers=3, cache_loc=CACHE_LOC):
+    """
+    Gets the predictions of all systems on the test data, running the systems in separate processes
+
+    Predictions are cached per system and test sample, only the samples of systems whose
+    model, KB, company data or code changed are predicted again.
+
+    :param test_data: the preprocessed test samples
+    :param n_workers: the number of processes, 1 runs all systems in the current process
+    :param cache_loc: path to the prediction cache, None disables caching
+    :return: dict mapping each system to its predictions
+    :rtype: dict
+    """
+
+    systems = ['el_system', 'baseline', 'baseline_context', 'majority']
+    keys = [row_key(sample) for sample in test_data]
+
+    # Look up the cached predictions of each system
+    cached = {system: dict() for system in systems}
+    if cache_loc:
+        cache = PredictionCache(cache_loc)
+        fingerprints = system_fingerprints()
+        for system in systems:
+            cached[system] = cache.get(system, fingerprints[system], keys)
+
+    # Select the samples that still have to be predicted by each system
+    missing = dict()
+    for system in systems:
+        missing_keys = dict()
+        for key, sample in zip(keys, test_data):
+            if key not in cached[system]:
+                missing_keys.setdefault(key, sample)
+        missing[system] = missing_keys
+        print(f"{system}: {len(cached[system])} cached, {len(missing_keys)} to predict.")
+
+    samples = {system: list(missing[system].values()) for system in systems}
+    tasks = []
+    if samples['el_system'] or samples['majority']:
+        tasks.append((linker_predictions, (samples,)))
+
+    # Load the company database and fit the vectorizer once for both name-matching baselines
+    if samples['baseline'] or samples['baseline_context']:
+        companies = load_companies(COMPANIES_LOC).explode('all_names')
+        vectorizer, clean_matrix = fit_vectorizer(companies)
+        if samples['baseline']:
+            tasks.append((name_baseline_predictions, (samples, companies, vectorizer, clean_matrix)))
+        if samples['baseline_context']:
+            tasks.append((context_baseline_predictions, (samples, companies, vectorizer, clean_matrix)))
+
+    new_predictions = dict()
+    if n_workers == 1:
+        for function, args in tasks:
+            new_predictions.update(function(*args))
+
+    elif tasks:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(function, *args) for function, args in tasks]
+            for future in futures:
+                new_predictions.update(future.result())
+
+    # Merge new and cached predictions and store the new ones
+    predictions = dict()
+    for system in systems:
+        system_preds = dict(zip(missing[system], map(str, new_predictions.get(system, []))))
+        if cache_loc and system_preds:
+            cache.put(system, fingerprints[system], system_preds)
+        system_preds.update(cached[system])
+        predictions[system] = [system_preds[key] for key in keys]
+
+    if cache_loc:
+        cache.close()
+
+    return predictions
+
+
+def evaluate(n_workers=3, cache_loc=CACHE_LOC):
     """Evaluates the trained model and three baseline systems on the test set"""
 
     # Load data and resources
     test_loc = "../data/model_data/test_data.tsv"
-    nlp = spacy.load('resources/nen_nlp_el_sentence')
-    kb = KnowledgeBase(vocab=nlp.vocab, entity_vector_length=96)
-    kb.load_bulk('resources/kb_probs')
 
     # Preprocess test data in lists of samples and gold_labels
     gold_labels, test_data = preprocess(test_loc)
@@ -267,45 +424,33 @@ def evaluate():
     print(f"{len(set(gold_labels))} unique KvK-numbers.")
 
     # Retrieve predictions on test set from all systems
-    print("Getting system predictions...")
-    system_preds = system_predictions(test_data)
-    print("Getting baseline predictions...")
-    baseline_preds = baseline_predictions(test_data)
-    print("Getting baseline with context predictions...")
-    base_context_preds = baseline_context_predictions(test_data)
-    print("Getting majority baseline predictions...")
-    majority_preds = majority_baseline(test_data, kb)
-
+    print("Getting system and baseline predictions...")
+    system_preds = run_systems(test_data, n_workers, cache_loc)
 
     # Print results for each system
-    print()
-    cr_system = sk.classification_report(gold_labels, system_preds, digits=3, output_dict=True, zero_division=False)
-    print("System predictions:")
-    print(cr_system['weighted avg'])
-
-    print()
-    cr_baseline = sk.classification_report(gold_labels, baseline_preds, digits=3, output_dict=True, zero_division=False)
-    print("Baseline predictions")
-    print(cr_baseline['weighted avg'])
-
-
-    print()
-    cr_base_context = sk.classification_report(gold_labels, base_context_preds, digits=3, output_dict=True, zero_division=False)
-    print("Baseline+context predictions")
-    print(cr_base_context['weighted avg'])
-
-
-    print()
-    cr_majority = sk.classification_report(gold_labels, majority_preds, digits=3, output_dict=True, zero_division=False)
-    print("Majority baseline predictions")
-    print(cr_majority['weighted avg'])
+    for system, name in [('el_system', "System predictions:"),
+                         ('baseline', "Baseline predictions"),
+                         ('baseline_context', "Baseline+context predictions"),
+                         ('majority', "Majority baseline predictions")]:
+        print()
+        cr = sk.classification_report(gold_labels, system_preds[system], digits=3, output_dict=True, zero_division=False)
+        print(name)
+        print(cr['weighted avg'])
 
     # Save predictions in a .tsv file to be used in error analysis
-    predictions['el_system'] = system_preds
+    predictions['el_system'] = system_preds['el_system']
     predictions_df = pd.DataFrame.from_dict(predictions)
     predictions_df.to_csv("../data/model_data/predictions.tsv", index=False, sep='\t')
     print("Saved predictions.tsv in ../data/model_data")
 
+    # Compute confidence intervals and significance of the differences with the trained model
+    print()
+    print("Computing bootstrap confidence intervals...")
+    significance_df = bootstrap_report(gold_labels, system_preds)
+    print(significance_df.to_string(index=False, float_format='%.3f'))
+    significance_df.to_csv("../data/model_data/significance.tsv", index=False, sep='\t')
+    print("Saved significance.tsv in ../data/model_data")
+
 def main():
     evaluate()
 
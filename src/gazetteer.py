@@ -0,0 +1,220 @@
+from collections import namedtuple, deque
+from string import punctuation
+
+
+class Mention(namedtuple('Mention', ['text', 'start_char', 'end_char', 'label_'])):
+    """A detected company mention, with the attributes of a spaCy span that get_orgs users rely on"""
+
+    __slots__ = ()
+
+    # Like a span, a mention is formatted as its text
+    def __str__(self):
+        return self.text
+
+
+def fold_case(text):
+    """Lowercases a text without changing its length, so offsets in the folded text are valid in the original"""
+
+    folded = text.lower()
+    if len(folded) == len(text):
+        return folded
+
+    # A few characters, such as 'İ', lowercase to more than one character, those are kept as they are
+    return ''.join(char.lower() if len(char.lower()) == 1 else char for char in text)
+
+
+class Gazetteer:
+    """
+    Finds known company names in texts with an Aho-Corasick automaton
+
+    All names are matched in a single pass over the text, so scanning takes time linear in the length
+    of the text (plus the number of matches), regardless of the number of names. A match only counts
+    if it starts and ends at a token boundary, so 'Shell' is not found in 'Shellfish'. Matching is
+    case-sensitive by default, like the alias lookups in the Knowledge Base. With `ignore_case`, the names
+    and the texts are lowercased, for names that were lowercased during preprocessing, such as the
+    `all_names` of the company database.
+    """
+
+    def __init__(self, names, min_length=3, label='ORG', ignore_case=False):
+        """
+        Compiles the names into the automaton
+
+        :param names: iterable of company names, such as the KB aliases and the names in `all_names`
+        :param min_length: names shorter than this are left out, they match too many ordinary words
+        :param label: the entity label of the mentions
+        :param ignore_case: whether to match the names regardless of case, the mentions keep the case of the text
+        """
+
+        self.label = label
+        self.ignore_case = ignore_case
+
+        # The trie: the transitions of each state, and the lengths of the names that end in each state
+        self.goto = [dict()]
+        self.out = [()]
+        self.n_names = 0
+        for name in set(names):
+            if not isinstance(name, str):
+                continue
+            name = name.strip()
+            if len(name) < min_length or name in punctuation:
+                continue
+            if ignore_case:
+                name = fold_case(name)
+
+            state = 0
+            for char in name:
+                if char not in self.goto[state]:
+                    self.goto.append(dict())
+                    self.out.append(())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            if not self.out[state]:
+                self.out[state] = (len(name),)
+                self.n_names += 1
+
+        # The failure links, computed breadth-first, each state also reports the names of its failure state
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    @classmethod
+    def from_kb(cls, kb, companies=None, **kwargs):
+        """
+        Builds a gazetteer from the aliases in a Knowledge Base and optionally the company names
+
+        :param kb: the spaCy Knowledge Base
+        :param companies: the company database with the `all_names` lists, these are lowercased during
+        preprocessing, so they only match with `ignore_case=True`
+        :return: the gazetteer
+        """
+
+        names = list(kb.get_alias_strings())
+        if companies is not None:
+            names.extend(name for names_list in companies['all_names'] for name in names_list)
+
+        return cls(names, **kwargs)
+
+    def matches(self, text):
+        """
+        Finds all occurrences of the names in a text that start and end at a token boundary
+
+        :return: list of (start_char, end_char) tuples, possibly overlapping
+        """
+
+        goto, fail, out = self.goto, self.fail, self.out
+        length = len(text)
+        found = []
+        if self.ignore_case:
+            text = fold_case(text)
+
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+
+            if out[state]:
+                end = i + 1
+                if end < length and text[end].isalnum():
+                    continue
+                for name_length in out[state]:
+                    start = end - name_length
+                    if start == 0 or not text[start - 1].isalnum():
+                        found.append((start, end))
+
+        return found
+
+    def find_all(self, text):
+        """
+        Finds all mentions of the names in a text, preferring the leftmost and then the longest match
+
+        :return: list of non-overlapping mentions, ordered by their position
+        """
+
+        mentions = []
+        last_end = 0
+        for start, end in sorted(self.matches(text), key=lambda match: (match[0], -match[1])):
+            if start >= last_end:
+                mentions.append(Mention(text[start:end], start, end, self.label))
+                last_end = end
+
+        return mentions
+
+    def find_orgs(self, text):
+        """
+        Finds the first mention of each distinct company name in a text, like utils.get_orgs
+
+        :return: list of mentions with text, start_char, end_char and label_
+        """
+
+        orgs = []
+        org_texts = set()
+        for mention in self.find_all(text):
+            if mention.text not in org_texts:
+                org_texts.add(mention.text)
+                orgs.append(mention)
+
+        return orgs
+
+    def contains_any(self, text):
+        """Checks whether a text mentions any of the names, stops at the first match"""
+
+        goto, fail, out = self.goto, self.fail, self.out
+        length = len(text)
+        if self.ignore_case:
+            text = fold_case(text)
+
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+
+            if out[state] and (i + 1 == length or not text[i + 1].isalnum()):
+                if any(i + 1 - name_length == 0 or not text[i - name_length].isalnum()
+                       for name_length in out[state]):
+                    return True
+
+        return False
+
+
+def merge_orgs(ner_orgs, gazetteer_orgs):
+    """
+    Merges the company mentions found by NER with those found by the gazetteer
+
+    NER mentions are kept as they are, gazetteer mentions are added if their text was not found by NER
+    and they do not overlap a NER mention.
+
+    :param ner_orgs: the mentions from utils.get_orgs
+    :param gazetteer_orgs: the mentions from Gazetteer.find_orgs
+    :return: the merged mentions, ordered by their position
+    """
+
+    ner_texts = set(org.text for org in ner_orgs)
+    ner_spans = sorted((org.start_char, org.end_char) for org in ner_orgs)
+
+    merged = list(ner_orgs)
+    for mention in gazetteer_orgs:
+        if mention.text in ner_texts:
+            continue
+        if any(start < mention.end_char and mention.start_char < end for start, end in ner_spans):
+            continue
+        merged.append(mention)
+
+    return sorted(merged, key=lambda org: org.start_char)
+
+
+def prefilter(articles, gazetteer):
+    """Yields only the articles that mention a known company name, to skip NER on the others"""
+
+    for article in articles:
+        if gazetteer.contains_any(article):
+            yield article
@@ -1,10 +1,173 @@
-import json
+import argparse
+import hashlib
+import random
+import re
 import jsonlines
 import spacy
 from spacy.kb import KnowledgeBase
+from prodigy_reader import read_jsonl
 
 
-def save_500():
+def candidate_counts(kb):
+    """Counts the candidates of every alias in the Knowledge Base, in one pass over the aliases"""
+
+    return {alias: len(kb.get_candidates(alias)) for alias in kb.get_alias_strings()}
+
+
+def eligible_samples(examples, counts, skip=0, one_per_article=False):
+    """
+    Yields the samples that can be double-annotated, with their position in the annotation input
+
+    These are the samples with a mention that has multiple candidates, leaving out the first `skip` of
+    them (those were already annotated by one annotator) and every later sample of a mention or
+    article that was already yielded.
+
+    :param examples: the annotation samples, in input order
+    :param counts: the number of candidates of each alias
+    :param skip: the number of multi-candidate samples at the start of the input to leave out
+    :param one_per_article: whether to yield at most one sample per article
+    :return: generator of (position, sample) tuples
+    """
+
+    seen_orgs = set()
+    seen_articles = set()
+    n_multi = 0
+    for position, example in enumerate(examples):
+        org = example['org']
+        if counts.get(org, 0) <= 1:
+            continue
+
+        n_multi += 1
+        if n_multi <= skip or org in seen_orgs:
+            continue
+
+        if one_per_article:
+            article = article_key(example['article'])
+            if article in seen_articles:
+                continue
+            seen_articles.add(article)
+
+        seen_orgs.add(org)
+        yield position, example
+
+
+def article_key(article):
+    """Returns a short hash of an article, so the seen-set does not hold full articles"""
+
+    return hashlib.blake2b(article.encode('utf8'), digest_size=8).digest()
+
+
+def article_source(example):
+    """Returns the website an annotation sample was published on, taken from the article link in its html"""
+
+    match = re.search(r"href='https?://(?:www\.)?([^/']+)", example.get('html', ''))
+
+    return match.group(1) if match else 'unknown'
+
+
+def reservoir_sample(items, k, rng):
+    """Takes a uniform random sample of k items from a stream in one pass (reservoir sampling)"""
+
+    reservoir = []
+    for n, item in enumerate(items):
+        if n < k:
+            reservoir.append(item)
+        else:
+            replace = rng.randint(0, n)
+            if replace < k:
+                reservoir[replace] = item
+
+    return reservoir
+
+
+def stratified_sample(items, k, key, rng):
+    """
+    Takes a random sample of k items from a stream in one pass, with each stratum represented in
+    proportion to its size
+
+    Every stratum keeps a reservoir of at most k items and its size, at the end the k items are
+    divided over the strata by largest remainder, with ties broken at random.
+
+    :param items: the stream of items
+    :param k: the sample size
+    :param key: function that returns the stratum of an item
+    :param rng: the random generator
+    :return: the sampled items
+    """
+
+    reservoirs = dict()
+    sizes = dict()
+    for item in items:
+        stratum = key(item)
+        n = sizes.get(stratum, 0)
+        sizes[stratum] = n + 1
+        reservoir = reservoirs.setdefault(stratum, [])
+        if n < k:
+            reservoir.append(item)
+        else:
+            replace = rng.randint(0, n)
+            if replace < k:
+                reservoir[replace] = item
+
+    # Divide the sample over the strata in proportion to their sizes
+    total = sum(sizes.values())
+    if total <= k:
+        return [item for reservoir in reservoirs.values() for item in reservoir]
+
+    quotas = {stratum: k * size / total for stratum, size in sizes.items()}
+    allocation = {stratum: int(quota) for stratum, quota in quotas.items()}
+    remainders = sorted(quotas, key=lambda stratum: (allocation[stratum] - quotas[stratum], rng.random()))
+    for stratum in remainders[:k - sum(allocation.values())]:
+        allocation[stratum] += 1
+
+    sample = []
+    for stratum, reservoir in reservoirs.items():
+        rng.shuffle(reservoir)
+        sample.extend(reservoir[:allocation[stratum]])
+
+    return sample
+
+
+def sample_iaa(examples, counts, limit=400, method='first', strata='candidates', skip=0, seed=1,
+               one_per_article=False):
+    """
+    Selects the samples for double annotation in a single pass over the annotation input
+
+    :param examples: the annotation samples
+    :param counts: the number of candidates of each alias
+    :param limit: the number of samples to select
+    :param method: 'first' takes the first eligible samples, 'reservoir' a uniform random sample and
+    'stratified' a random sample stratified by `strata`
+    :param strata: 'candidates' stratifies by the number of candidates of the mention (5 or more in one
+    stratum), 'source' by the website the article was published on
+    :param skip: the number of multi-candidate samples at the start of the input to leave out
+    :param seed: the seed of the random generator, the same seed and input give the same sample
+    :param one_per_article: whether to take at most one sample per article, with any method
+    :return: the selected samples, in input order
+    """
+
+    rng = random.Random(seed)
+    items = eligible_samples(examples, counts, skip, one_per_article)
+
+    if method == 'first':
+        sample = [item for n, item in zip(range(limit), items)]
+    elif method == 'reservoir':
+        sample = reservoir_sample(items, limit, rng)
+    elif method == 'stratified':
+        if strata == 'candidates':
+            key = lambda item: min(counts[item[1]['org']], 5)
+        elif strata == 'source':
+            key = lambda item: article_source(item[1])
+        else:
+            raise ValueError(f"Unknown strata: {strata}")
+        sample = stratified_sample(items, limit, key, rng)
+    else:
+        raise ValueError(f"Unknown sampling method: {method}")
+
+    return [example for position, example in sorted(sample, key=lambda item: item[0])]
+
+
+def save_iaa_input(limit=400, method='first', strata='candidates', skip=4070, seed=1, one_per_article=False):
     # Prepare datafiles
     json_loc = "../../data/prodigy_data/annotations_input.jsonl"
     new_loc = "../../data/prodigy_data/iaa_input.jsonl"
@@ -14,33 +177,30 @@ def save_500():
     kb = KnowledgeBase(vocab=nlp.vocab, entity_vector_length=96)
     kb.load_bulk('../resources/kb_initial')
 
-    i = 0
-    j = 0
-    unique_orgs = []
-    limit = 400
+    # Select the samples in one pass over the annotations
+    counts = candidate_counts(kb)
+    sample = sample_iaa(read_jsonl(json_loc), counts, limit, method, strata, skip, seed, one_per_article)
 
-    # Open file to save IAA-annotations in
-    outfile = jsonlines.open(new_loc, 'w')
+    # Save the IAA-annotations
+    with jsonlines.open(new_loc, 'w') as outfile:
+        outfile.write_all(sample)
 
-    # Go through all annotations
-    with open(json_loc, 'r', encoding='utf8') as jsonfile:
-        for line in jsonfile:
-            example = json.loads(line)
-            org = example['org']
-            if len(kb.get_candidates(org)) > 1:
-                i += 1
-                if i > 4070 and org not in unique_orgs and j < limit:
-                    j += 1
-                    outfile.write(example)
-                    unique_orgs.append(org)
-                    print(j, ", sample: ", i)
-
-    outfile.close()
-    print(f"{limit} IAA-annotations Prodigy input saved in ../prodigy/iaa_input.jsonl")
+    print(f"{len(sample)} IAA-annotations Prodigy input saved in {new_loc}")
 
 
 def main():
-    save_500()
+    # The first 4070 multi-candidate samples were annotated by one annotator before the IAA round
+    parser = argparse.ArgumentParser(description="Selects a set of annotation samples for double annotation.")
+    parser.add_argument('--limit', type=int, default=400)
+    parser.add_argument('--method', choices=['first', 'reservoir', 'stratified'], default='first')
+    parser.add_argument('--strata', choices=['candidates', 'source'], default='candidates')
+    parser.add_argument('--one-per-article', action='store_true', help="Take at most one sample per article")
+    parser.add_argument('--skip', type=int, default=4070,
+                        help="Number of multi-candidate samples at the start of the input to leave out")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    save_iaa_input(args.limit, args.method, args.strata, args.skip, args.seed, args.one_per_article)
 
 
 if __name__ == '__main__':
@@ -1,5 +1,5 @@
-import json
 import jsonlines
+from prodigy_reader import read_jsonl
 from sklearn.metrics import cohen_kappa_score
 
 
@@ -7,19 +7,17 @@ def load_annotations(path):
     annotator1 = dict()
     annotator2 = dict()
 
-    with open(path, 'r', encoding='utf8') as jsonfile:
-        for sample in jsonfile:
-            anno = json.loads(sample)
-            if anno['_session_id'] == 'iaa2-Jona':
-                if anno['answer'] == 'accept':
-                    annotator1[anno['_input_hash']] = anno['accept'][0]
-                else:
-                    annotator1[anno['_input_hash']] = 'reject'
+    for anno in read_jsonl(path, fields=['_session_id', 'answer', 'accept', '_input_hash']):
+        if anno['_session_id'] == 'iaa2-Jona':
+            if anno['answer'] == 'accept':
+                annotator1[anno['_input_hash']] = anno['accept'][0]
             else:
-                if anno['answer'] == 'accept':
-                    annotator2[anno['_input_hash']] = anno['accept'][0]
-                else:
-                    annotator2[anno['_input_hash']] = 'reject'
+                annotator1[anno['_input_hash']] = 'reject'
+        else:
+            if anno['answer'] == 'accept':
+                annotator2[anno['_input_hash']] = anno['accept'][0]
+            else:
+                annotator2[anno['_input_hash']] = 'reject'
 
 
     print(len(annotator1), len(annotator2))
@@ -78,25 +76,24 @@ def add_annotations(path):
 
     writer = jsonlines.open(annotations, 'a')
 
-    with open(path, 'r', encoding='utf8') as jsonfile:
-        for line in jsonfile:
-            sample = json.loads(line)
-            if sample['_session_id'] == 'iaa2-Jona' and sample['accept']:
-                id = sample['_input_hash']
-                add[id] = sample
-            elif sample['accept']:
-                id2 = sample['_input_hash']
-
-                if sample['accept'] and id2 in add:
-                    sample2 = sample['accept'][0]
-                    sample1 = add[id2]['accept'][0]
-
-                    if sample1 == sample2:
-                        if sample1 not in ["NIL_notanorg", "NIL_otherentity", "NIL_ambiguous", "reject"]:
-                            annotation = add[id2]
-                            annotation["_session_id"] = 'iaa-Rogier'
-                            writer.write(annotation)
-                            count += 1
+    # Only samples with an accepted option can be added
+    for sample in read_jsonl(path, where=lambda sample: sample['accept']):
+        if sample['_session_id'] == 'iaa2-Jona':
+            id = sample['_input_hash']
+            add[id] = sample
+        else:
+            id2 = sample['_input_hash']
+
+            if id2 in add:
+                sample2 = sample['accept'][0]
+                sample1 = add[id2]['accept'][0]
+
+                if sample1 == sample2:
+                    if sample1 not in ["NIL_notanorg", "NIL_otherentity", "NIL_ambiguous", "reject"]:
+                        annotation = add[id2]
+                        annotation["_session_id"] = 'iaa-Rogier'
+                        writer.write(annotation)
+                        count += 1
 
     writer.close()
 
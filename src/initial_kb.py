@@ -1,9 +1,15 @@
+import sys
 from spacy.kb import KnowledgeBase
 from utils import *
+from dedup import load_clusters, cluster_sizes
+from entity_vectors import EntityVectors
+from profiling import timed
+from progress import Progress
 from collections import defaultdict
 from sklearn.feature_extraction.text import TfidfVectorizer
 
 
+@timed
 def add_entities(kb, desc_dict, nlp):
     """
     Adds company entities to KB
@@ -14,28 +20,31 @@ def add_entities(kb, desc_dict, nlp):
     :return: the KB with companies entities added
     """
 
-    # Add entities (set_entities)
+    # Encode the SBI-code descriptions, each unique description only once
     print("Adding entities to KB...")
-    for n, (kvk, desc) in enumerate(desc_dict.items()):
-        if n % 1000 == 0:
-            print(f"{n}/{len(desc_dict)} entities added.")
+    desc_matrix = get_vectors(list(desc_dict.values()), nlp)
 
-        desc_doc = nlp(desc)
-        desc_enc = desc_doc.vector
+    # Add entities (set_entities)
+    progress = Progress('add_entities', total=len(desc_dict), unit='entities')
+    for kvk, desc_enc in zip(desc_dict, desc_matrix):
         kb.add_entity(entity=str(kvk), entity_vector=desc_enc, freq=1)
+        progress.update()
+    progress.close()
 
     print("Done adding entities!")
 
     return kb
 
 
-def find_candidates(companies, news,  nlp):
+def find_candidates(companies, news,  nlp, known_mentions=(), clusters=None):
     """
     Function to find candidates for each company mention in the news articles
 
     :param companies: the database with company entities
     :param news: the news database
     :param nlp: spaCy nlp object to perform NER
+    :param known_mentions: mentions that already have candidates, such as the aliases in an existing KB
+    :param clusters: the representative of each article's near-duplicate cluster, NER only runs on the representatives
     :return: a dictionary with mentions as keys and their candidates as values
     """
 
@@ -46,29 +55,35 @@ def find_candidates(companies, news,  nlp):
     articles_with_mentions = 0
     n_mentions = 0
 
+    # Each representative article counts for all near-duplicates in its cluster
+    sizes = cluster_sizes(clusters) if clusters is not None else np.ones(n_articles, dtype=int)
+
+    # Prepare vectorizer, the company names are the same for every article
+    vectorizer = TfidfVectorizer(min_df=1, analyzer=ngrams_chars, lowercase=False)
+    clean_matrix = vectorizer.fit_transform(companies["all_names"])
+
     # Find candidates for entity mentions
     print()
     print("Finding candidates for mentions...")
+    progress = Progress('find_candidates', total=n_articles, unit='articles')
     for n, article in enumerate(news['full_text']):
         flag = False
-        if n % 10 == 0:
-            print(f"{n}/{n_articles} processed.")
-            print(f"{len(mention_cands)} mentions with candidates")
+        progress.update(mentions_with_candidates=len(mention_cands))
 
-        # Prepare vectorizer
-        vectorizer = TfidfVectorizer(min_df=1, analyzer=ngrams_chars, lowercase=False)
-        clean_matrix = vectorizer.fit_transform(companies["all_names"])
+        # Near-duplicates have the same mentions as their representative
+        if not sizes[n]:
+            continue
 
         # Extract Named Entities from the article
         mentions = [ent.text for ent in get_orgs(article, nlp)]
-        n_mentions += len(mentions)
+        n_mentions += len(mentions) * sizes[n]
 
         # Find candidates for each entity mentions in the articles
         for company in mentions:
 
             # Only find candidates for mentions that don't already have candidates
             # Different articles can contain the same mentions
-            if company not in mention_cands:
+            if company not in mention_cands and company not in known_mentions:
 
                 # Extrac the candidates
                 candidate_comps = resolve_org(company, vectorizer, clean_matrix, companies)
@@ -81,8 +96,9 @@ def find_candidates(companies, news,  nlp):
 
         # Count articles that contain mentions
         if flag:
-            articles_with_mentions += 1
+            articles_with_mentions += sizes[n]
 
+    progress.close(mentions_with_candidates=len(mention_cands))
     print()
     print("Total number of org/norp mentions in articles:")
     print(f"{n_mentions} ORG/NORP mentions")
@@ -107,11 +123,9 @@ def add_aliases(mention_cands, kb):
     print("Adding aliases to knowledge base...")
 
     # Go through all mentions in the mention/candidate dict
-    for n, mention in enumerate(mention_cands):
-
-        # Print progress
-        if n % 10 == 0:
-            print(f"{n}/{len(mention_cands)} added")
+    progress = Progress('add_aliases', total=len(mention_cands), unit='aliases')
+    for mention in mention_cands:
+        progress.update()
 
         # Find candidates and prior probabilities
         candidates = mention_cands[mention]
@@ -124,6 +138,8 @@ def add_aliases(mention_cands, kb):
         # Add each alias to the Knowledge Base
         kb.add_alias(mention, candidates, probabilities)
 
+    progress.close()
+
     # Print size of KB
     n_aliases = kb.get_size_aliases()
     print(f"{n_aliases} aliases added.")
@@ -134,10 +150,8 @@ def add_aliases(mention_cands, kb):
 def create_kb():
 
     # Load datasets
-    companies = pd.read_csv('../data/model_data/prepro_companies.tsv', sep='\t')
-    companies['all_names'] = string_to_list(companies['all_names'])
-    news = pd.read_csv('../data/model_data/prepro_news.tsv', sep='\t')
-    news['orgs'] = string_to_list(news['orgs'])
+    companies = load_companies()
+    news = load_news(columns=['full_text'])
     nlp = spacy.load('../resources/nen_nlp')
 
     # Create dictionaries to map Kvk_numbers to company names and sbi code descriptions
@@ -151,8 +165,12 @@ def create_kb():
     kb = add_entities(kb, desc_dict, nlp)
     kb.dump("../resources/kb_entities")
 
+    # Save the entity vectors once per unique SBI-code description
+    EntityVectors.from_kb(kb).save("../resources/entity_vectors")
+
     # Find candidates for each mention in the news data
-    mention_cands = find_candidates(companies, news, name_dict)
+    clusters = load_clusters(news['full_text'])
+    mention_cands = find_candidates(companies, news, nlp, clusters=clusters)
 
     # Add aliases for all mentions with candidates to Knowledge Base
     kb = add_aliases(mention_cands, kb)
@@ -164,9 +182,32 @@ def create_kb():
     nlp.to_disk("../resources/nen_nlp")
 
 
+def update_kb(delta_path='../data/model_data/prepro_news_delta.tsv'):
+    """Adds the new mentions in a delta of preprocessed news articles as aliases to the initial KB"""
+
+    # Load datasets and the existing Knowledge Base
+    companies = load_companies()
+    news = pd.read_csv(delta_path, sep='\t')
+    nlp = spacy.load('../resources/nen_nlp')
+    kb = KnowledgeBase(vocab=nlp.vocab, entity_vector_length=96)
+    kb.load_bulk("../resources/kb_initial")
+
+    # Find candidates only for mentions that are not in the Knowledge Base yet
+    known_mentions = set(kb.get_alias_strings())
+    mention_cands = find_candidates(companies, news, nlp, known_mentions)
+    kb = add_aliases(mention_cands, kb)
+
+    # Save Knowledge Base and NLP
+    kb.dump("../resources/kb_initial")
+    nlp.to_disk("../resources/nen_nlp")
+
+
 def main():
     create_kb()
 
 
 if __name__ == "__main__":
-    main()
+    if '--delta' in sys.argv:
+        update_kb()
+    else:
+        main()
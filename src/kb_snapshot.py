@@ -0,0 +1,232 @@
+import argparse
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from entity_vectors import EntityVectors
+from option_cache import alias_hash
+from prediction_cache import file_stats
+
+SNAPSHOT_LOC = 'resources/kb_snapshot'
+
+ALIAS_DTYPE = np.dtype([('hash', '<u8'), ('alias_offset', '<u8'), ('alias_length', '<u4'),
+                        ('candidate_offset', '<u8'), ('n_candidates', '<u4')])
+
+# A candidate of an alias, with the attributes of a spaCy Candidate that the scripts rely on
+Candidate = namedtuple('Candidate', ['entity_', 'alias_', 'prior_prob', 'entity_freq', 'entity_vector'])
+
+
+def export_snapshot(kb, out_dir, kb_loc=None, dtype='float32'):
+    """
+    Exports a Knowledge Base to a snapshot of flat arrays that can be memory-mapped
+
+    The snapshot holds a table of the aliases sorted by their 64-bit hash, the candidates of all aliases
+    in one pair of arrays (entity and prior probability) that the table points into, the entity
+    frequencies and the entity vectors as a store of unique vectors.
+
+    :param kb: the spaCy Knowledge Base
+    :param out_dir: the directory to save the snapshot in
+    :param kb_loc: the directory the Knowledge Base was loaded from, to detect when the snapshot is outdated
+    :param dtype: the type of the entity vectors, 'float32', 'float16' or 'int8'
+    """
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    # The entities are sorted in the vector store, candidates refer to them by their position
+    store = EntityVectors.from_kb(kb, dtype)
+    store.save(os.path.join(out_dir, 'vectors'))
+    positions = {str(entity): n for n, entity in enumerate(store.entities)}
+    freqs = np.ones(len(store), dtype=np.int32)
+
+    aliases = []
+    candidate_entities = []
+    candidate_priors = []
+    alias_offset = 0
+    with open(os.path.join(out_dir, 'aliases.bin'), 'wb') as outfile:
+        for alias in kb.get_alias_strings():
+            candidates = kb.get_candidates(alias)
+            encoded = alias.encode('utf8')
+            outfile.write(encoded)
+            aliases.append((alias_hash(alias), alias_offset, len(encoded), len(candidate_entities), len(candidates)))
+            alias_offset += len(encoded)
+
+            for c in candidates:
+                candidate_entities.append(positions[c.entity_])
+                candidate_priors.append(c.prior_prob)
+                freqs[positions[c.entity_]] = c.entity_freq
+
+    table = np.array(aliases, dtype=ALIAS_DTYPE)
+    table.sort(order='hash', kind='stable')
+    np.save(os.path.join(out_dir, 'aliases.npy'), table)
+    np.save(os.path.join(out_dir, 'candidate_entities.npy'), np.array(candidate_entities, dtype=np.int32))
+    np.save(os.path.join(out_dir, 'candidate_priors.npy'), np.array(candidate_priors, dtype=np.float32))
+    np.save(os.path.join(out_dir, 'entity_freqs.npy'), freqs)
+
+    meta = {'entity_vector_length': kb.entity_vector_length,
+            'kb_stats': file_stats(kb_loc) if kb_loc else None}
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as outfile:
+        json.dump(meta, outfile)
+
+    print(f"Saved a snapshot of {len(table)} aliases, {len(candidate_entities)} candidates and {len(store)} "
+          f"entities in {out_dir}")
+
+
+class KBSnapshot:
+    """
+    Read-only lookups in a memory-mapped Knowledge Base snapshot
+
+    Opening a snapshot only maps its files, the pages are read when they are used and are shared through
+    the page cache by all processes that open the same snapshot. The lookup methods mirror those of the
+    spaCy Knowledge Base.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as infile:
+            self.meta = json.load(infile)
+
+        self.entity_vector_length = self.meta['entity_vector_length']
+        self.aliases = np.load(os.path.join(path, 'aliases.npy'), mmap_mode='r')
+        self.hashes = self.aliases['hash']
+        self.candidate_entities = np.load(os.path.join(path, 'candidate_entities.npy'), mmap_mode='r')
+        self.candidate_priors = np.load(os.path.join(path, 'candidate_priors.npy'), mmap_mode='r')
+        self.entity_freqs = np.load(os.path.join(path, 'entity_freqs.npy'), mmap_mode='r')
+        self.vectors = EntityVectors.load(os.path.join(path, 'vectors'))
+        self.entities = self.vectors.entities
+        self._alias_file = open(os.path.join(path, 'aliases.bin'), 'rb')
+        size = os.fstat(self._alias_file.fileno()).st_size
+        self._alias_blob = np.memmap(self._alias_file, dtype=np.uint8, mode='r') if size else np.zeros(0, np.uint8)
+
+    def _alias_string(self, entry):
+        offset = int(entry['alias_offset'])
+        return self._alias_blob[offset:offset + int(entry['alias_length'])].tobytes().decode('utf8')
+
+    def _find_alias(self, alias):
+        """Returns the table entry of an alias, or None if it is not in the snapshot"""
+
+        key = np.uint64(alias_hash(alias))
+        position = int(np.searchsorted(self.hashes, key))
+
+        # Aliases with the same hash are next to each other, the stored string tells them apart
+        while position < len(self.hashes) and self.hashes[position] == key:
+            entry = self.aliases[position]
+            if self._alias_string(entry) == alias:
+                return entry
+            position += 1
+
+        return None
+
+    def _candidate_rows(self, alias):
+        entry = self._find_alias(alias)
+        if entry is None:
+            return slice(0, 0)
+
+        offset = int(entry['candidate_offset'])
+        return slice(offset, offset + int(entry['n_candidates']))
+
+    def get_candidates(self, alias):
+        """
+        Returns the candidates of an alias
+
+        :param alias: the company mention
+        :return: list of candidates with entity_, alias_, prior_prob, entity_freq and entity_vector
+        """
+
+        rows = self._candidate_rows(alias)
+        return [Candidate(str(self.entities[entity]), alias, float(prior), int(self.entity_freqs[entity]),
+                          self.vectors.vector(int(self.vectors.rows[entity])))
+                for entity, prior in zip(self.candidate_entities[rows], self.candidate_priors[rows])]
+
+    def get_prior_prob(self, entity, alias):
+        """Returns the prior probability of an entity for an alias, 0 if it is not a candidate"""
+
+        rows = self._candidate_rows(alias)
+        for candidate, prior in zip(self.candidate_entities[rows], self.candidate_priors[rows]):
+            if self.entities[candidate] == str(entity):
+                return float(prior)
+
+        return 0.0
+
+    def get_vector(self, entity):
+        """Returns the entity vector of an entity"""
+
+        vector = self.vectors.get(entity)
+        if vector is None:
+            raise KeyError(f"Unknown entity: {entity}")
+
+        return vector
+
+    def get_alias_strings(self):
+        return [self._alias_string(entry) for entry in self.aliases]
+
+    def get_entity_strings(self):
+        return [str(entity) for entity in self.entities]
+
+    def contains_alias(self, alias):
+        return self._find_alias(alias) is not None
+
+    def contains_entity(self, entity):
+        return entity in self.vectors
+
+    def get_size_aliases(self):
+        return len(self.aliases)
+
+    def get_size_entities(self):
+        return len(self.entities)
+
+    def is_current(self, kb_loc):
+        """Checks whether the Knowledge Base files are unchanged since the snapshot was exported"""
+
+        return os.path.exists(kb_loc) and self.meta['kb_stats'] == file_stats(kb_loc)
+
+    def close(self):
+        del self._alias_blob
+        self._alias_file.close()
+
+
+def load_kb(kb_loc, vocab, snapshot_loc=SNAPSHOT_LOC, entity_vector_length=96):
+    """
+    Opens the snapshot of a Knowledge Base if it is up to date, and else loads the Knowledge Base itself
+
+    :param kb_loc: the directory of the Knowledge Base
+    :param vocab: the vocab of the nlp object, only used to load the Knowledge Base
+    :param snapshot_loc: the directory of the snapshot
+    :param entity_vector_length: the length of the entity vectors in the Knowledge Base
+    :return: a KBSnapshot or a spaCy KnowledgeBase
+    """
+
+    if snapshot_loc and os.path.exists(os.path.join(snapshot_loc, 'meta.json')):
+        snapshot = KBSnapshot(snapshot_loc)
+        if snapshot.is_current(kb_loc):
+            return snapshot
+        snapshot.close()
+        print(f"Snapshot {snapshot_loc} is older than {kb_loc}, loading the Knowledge Base instead.")
+
+    from spacy.kb import KnowledgeBase
+
+    kb = KnowledgeBase(vocab=vocab, entity_vector_length=entity_vector_length)
+    kb.load_bulk(kb_loc)
+
+    return kb
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Exports a Knowledge Base to a memory-mapped snapshot.")
+    parser.add_argument('--kb', default='resources/kb_probs')
+    parser.add_argument('--nlp', default='resources/nen_nlp')
+    parser.add_argument('--output', default=SNAPSHOT_LOC)
+    parser.add_argument('--dtype', choices=['float32', 'float16', 'int8'], default='float32')
+    args = parser.parse_args(argv)
+
+    import spacy
+    from spacy.kb import KnowledgeBase
+
+    nlp = spacy.load(args.nlp)
+    kb = KnowledgeBase(vocab=nlp.vocab, entity_vector_length=96)
+    kb.load_bulk(args.kb)
+    export_snapshot(kb, args.output, args.kb, args.dtype)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import argparse
+import csv
+import json
+import sys
+
+import spacy
+
+ID_FIELDS = ['article_id', 'id', 'url']
+TEXT_FIELDS = ['full_text', 'article', 'text']
+
+
+def read_articles(infile, input_format):
+    """
+    Streams (text, article_id) tuples from a TSV or JSON lines file
+
+    :param infile: the opened input file
+    :param input_format: 'tsv' or 'jsonl'
+    :return: generator of (text, article_id) tuples
+    """
+
+    if input_format == 'tsv':
+        # News articles can be longer than the default field size limit
+        csv.field_size_limit(sys.maxsize)
+        rows = csv.DictReader(infile, delimiter='\t')
+    else:
+        rows = (json.loads(line) for line in infile if line.strip())
+
+    for n, row in enumerate(rows):
+
+        # Use the first available id and text fields, and the line number if there is no id
+        article_id = next((row[field] for field in ID_FIELDS if row.get(field)), n)
+        text = next((row[field] for field in TEXT_FIELDS if row.get(field)), None)
+        if text:
+            yield text, article_id
+
+
+def doc_links(doc, kb, include_nil=False, include_candidates=False):
+    """
+    Extracts the linked company mentions from a doc processed by the Entity Linking pipeline
+
+    :param doc: the processed spaCy doc
+    :param kb: the Knowledge Base of the entity linker, to look up prior probabilities
+    :param include_nil: whether to include mentions that could not be linked
+    :param include_candidates: whether to add all candidates of the mention with their prior probabilities
+    :return: generator of dicts with mention, offsets, KvK-number and score
+    """
+
+    for ent in doc.ents:
+        kvk = ent.kb_id_
+
+        # Entities with labels that are discarded by the entity linker get no KB id
+        if not kvk or (kvk == 'NIL' and not include_nil):
+            continue
+
+        score = kb.get_prior_prob(kvk, ent.text) if kvk != 'NIL' else 0.0
+        link = {'mention': ent.text,
+                'offsets': [ent.start_char, ent.end_char],
+                'kvk': kvk,
+                'score': round(float(score), 4)}
+
+        if include_candidates:
+            link['candidates'] = [{'kvk': c.entity_, 'prior': round(float(c.prior_prob), 4)}
+                                  for c in kb.get_candidates(ent.text)]
+
+        yield link
+
+
+def link_articles(articles, nlp, batch_size=64, n_process=1, include_nil=False):
+    """
+    Runs NER and entity linking on a stream of articles
+
+    :param articles: iterable of (text, article_id) tuples
+    :param nlp: the Entity Linking pipeline
+    :param batch_size: the number of articles per batch
+    :param n_process: the number of processes nlp.pipe uses
+    :param include_nil: whether to include mentions that could not be linked
+    :return: generator of link records
+    """
+
+    kb = nlp.get_pipe('entity_linker').kb
+    for doc, article_id in nlp.pipe(articles, as_tuples=True, batch_size=batch_size, n_process=n_process):
+        for link in doc_links(doc, kb, include_nil):
+            yield {'article_id': article_id, **link}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Links company mentions in news articles to KvK-numbers.")
+    parser.add_argument('input', nargs='?', default='-', help="TSV or JSON lines file with articles, - for stdin")
+    parser.add_argument('--output', default='-', help="JSON lines file to write the links to, - for stdout")
+    parser.add_argument('--format', choices=['tsv', 'jsonl'], default=None,
+                        help="Input format, inferred from the file extension if omitted")
+    parser.add_argument('--model', default='resources/nen_nlp_el_sentence')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--n-process', type=int, default=1)
+    parser.add_argument('--include-nil', action='store_true', help="Also write mentions that could not be linked")
+    args = parser.parse_args()
+
+    input_format = args.format or ('jsonl' if args.input.endswith(('.jsonl', '.json')) else 'tsv')
+    nlp = spacy.load(args.model)
+
+    infile = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf8', newline='')
+    outfile = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf8')
+
+    # Articles are read, linked and written batch by batch, so memory use does not grow with the input
+    n_links = 0
+    try:
+        articles = read_articles(infile, input_format)
+        for link in link_articles(articles, nlp, args.batch_size, args.n_process, args.include_nil):
+            outfile.write(json.dumps(link, ensure_ascii=False) + '\n')
+            n_links += 1
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+
+    print(f"Wrote {n_links} links.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,273 @@
-import preprocessing, initial_kb, annotation_preprocessing
-import iaa, probs_kb, training, evaluation, error_analysis
-
-preprocessing.main()
-initial_kb.main()
-annotation_preprocessing.main()
-iaa.main()
-probs_kb.main()
-training.main()
-evaluation.main()
-error_analysis.main()
+import argparse
+import importlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import profiling
+from prediction_cache import file_stats, fingerprint_path, combine_fingerprints
+
+STATE_LOC = '../data/model_data/pipeline_state.json'
+PROFILE_LOC = '../data/model_data/profile.json'
+
+# The stages of the pipeline, with the files they read and write and the stages they run after.
+# Paths are written the way the stage scripts use them. A stage reruns when its source code, its inputs
+# or the outputs of the stages it depends on change, or when one of its outputs is missing. The sources are
+# the stage script and every module of this directory it imports at module level, directly or indirectly.
+STAGES = {
+    'preprocessing': {
+        'sources': ['preprocessing.py', 'utils.py', 'profiling.py'],
+        'inputs': ['../data/model_data/nen_news.tsv', '../data/model_data/nen_companies.tsv'],
+        'outputs': ['../data/model_data/prepro_news.tsv', '../data/model_data/prepro_news.parquet',
+                    '../data/model_data/prepro_companies.tsv', '../data/model_data/prepro_companies.parquet',
+                    '../data/model_data/entities.tsv'],
+        'deps': []},
+    'dedup': {
+        'sources': ['dedup.py', 'utils.py', 'profiling.py'],
+        'inputs': [],
+        'outputs': ['../data/model_data/news_clusters.tsv', '../data/model_data/news_clusters.json'],
+        'deps': ['preprocessing']},
+    'initial_kb': {
+        'sources': ['initial_kb.py', 'dedup.py', 'entity_vectors.py', 'utils.py', 'profiling.py', 'progress.py'],
+        'inputs': [],
+        'outputs': ['../resources/kb_entities', '../resources/kb_initial', '../resources/nen_nlp',
+                    '../resources/entity_vectors'],
+        'deps': ['preprocessing', 'dedup']},
+    'annotation_preprocessing': {
+        'sources': ['annotation_preprocessing.py', 'prodigy_reader.py', 'progress.py'],
+        'inputs': ['../data/prodigy_data/annotations+iaa_output.jsonl', 'resources/nen_nlp'],
+        'outputs': ['../data/model_data/all_data.tsv', '../data/model_data/train_data.tsv',
+                    '../data/model_data/dev_data.tsv', '../data/model_data/test_data.tsv'],
+        'deps': ['initial_kb']},
+    # iaa appends to the annotations that annotation_preprocessing reads, so that file is not declared as
+    # its output, which would make a cycle. It runs only when the IAA annotations or its code change.
+    'iaa': {
+        'sources': ['iaa.py', 'prodigy_reader.py'],
+        'inputs': ['../data/prodigy_data/iaa_output.jsonl'],
+        'outputs': [],
+        'deps': ['annotation_preprocessing']},
+    'probs_kb': {
+        'sources': ['probs_kb.py', 'progress.py'],
+        'inputs': ['resources/nen_nlp', 'resources/kb_initial', 'resources/kb_entities'],
+        'outputs': ['../resources/kb_probs'],
+        'deps': ['initial_kb', 'annotation_preprocessing']},
+    'training': {
+        'sources': ['training.py', 'profiling.py', 'progress.py'],
+        'inputs': ['resources/nen_nlp', 'resources/kb_probs'],
+        'outputs': ['resources/nen_nlp_el_sentence'],
+        'deps': ['probs_kb', 'annotation_preprocessing']},
+    'kb_snapshot': {
+        'sources': ['kb_snapshot.py', 'entity_vectors.py', 'option_cache.py', 'prediction_cache.py'],
+        'inputs': ['resources/nen_nlp', 'resources/kb_probs'],
+        'outputs': ['resources/kb_snapshot'],
+        'deps': ['probs_kb']},
+    'evaluation': {
+        'sources': ['evaluation.py', 'metrics.py', 'prediction_cache.py', 'kb_snapshot.py', 'entity_vectors.py',
+                    'option_cache.py', 'utils.py', 'profiling.py', 'progress.py'],
+        'inputs': ['resources/kb_probs'],
+        'outputs': ['../data/model_data/predictions.tsv', '../data/model_data/significance.tsv'],
+        'deps': ['training', 'kb_snapshot', 'annotation_preprocessing', 'preprocessing']},
+    'error_analysis': {
+        'sources': ['error_analysis.py'],
+        'inputs': ['../resources/nen_nlp', '../resources/kb_probs'],
+        'outputs': [],
+        'deps': ['evaluation', 'preprocessing']},
+}
+
+
+def load_state(state_loc=STATE_LOC):
+    """Loads the fingerprints of the last successful run of each stage"""
+
+    if not os.path.exists(state_loc):
+        return {'stages': {}, 'files': {}}
+
+    with open(state_loc, 'r', encoding='utf8') as infile:
+        return json.load(infile)
+
+
+def save_state(state, state_loc=STATE_LOC):
+    """Saves the fingerprints, via a temporary file so an interrupted run does not corrupt them"""
+
+    with open(state_loc + '.tmp', 'w', encoding='utf8') as outfile:
+        json.dump(state, outfile, indent=2)
+    os.replace(state_loc + '.tmp', state_loc)
+
+
+def fingerprint(path, file_cache):
+    """
+    Computes the content hash of a file or directory
+
+    The hash is reused from the previous run when the sizes and modification times are unchanged,
+    so large datasets and models are only read again after they changed.
+
+    :param path: the file or directory
+    :param file_cache: dict with the stats and hashes of the previous run, updated in place
+    :return: the content hash, or 'missing' if the path does not exist
+    """
+
+    if not os.path.exists(path):
+        return 'missing'
+
+    stats = file_stats(path)
+    cached = file_cache.get(path)
+    if cached and cached['stats'] == stats:
+        return cached['hash']
+
+    digest = fingerprint_path(path)
+    file_cache[path] = {'stats': stats, 'hash': digest}
+
+    return digest
+
+
+def stage_fingerprint(name, file_cache):
+    """Combines the fingerprints of the code, the inputs and the outputs of the dependencies of a stage"""
+
+    stage = STAGES[name]
+    paths = stage['sources'] + stage['inputs']
+    for dep in stage['deps']:
+        paths += STAGES[dep]['outputs']
+
+    # A stage that reads and writes the same path should not invalidate itself
+    paths = [path for path in dict.fromkeys(paths) if path not in stage['outputs']]
+
+    return combine_fingerprints(*[f"{path}:{fingerprint(path, file_cache)}" for path in paths])
+
+
+def stage_levels(names):
+    """
+    Orders the stages in levels, every stage runs after all stages it depends on
+
+    :param names: the stages to order
+    :return: list of lists of stage names, the stages in one level can run in parallel
+    """
+
+    levels = []
+    done = set()
+    remaining = list(names)
+    while remaining:
+        level = [name for name in remaining if all(dep in done or dep not in names for dep in STAGES[name]['deps'])]
+        if not level:
+            raise ValueError(f"The stages {remaining} depend on each other")
+        levels.append(level)
+        done.update(level)
+        remaining = [name for name in remaining if name not in done]
+
+    return levels
+
+
+def run_stage(name, profile=False):
+    """
+    Runs the main function of a stage, in a fresh worker process
+
+    :return: the wall time, CPU time, peak memory and function timers of the stage if profiling, else None
+    """
+
+    # Profiling has to be enabled before the stage imports the timed functions
+    if profile:
+        profiling.enable()
+
+    # Stages that parse command line arguments should not see the arguments of the runner
+    sys.argv = [f'{name}.py']
+
+    module = importlib.import_module(name)
+    if not profile:
+        module.main()
+        return None
+
+    result, stats = profiling.profile_call(module.main)
+
+    return stats
+
+
+def run_pipeline(force=(), n_jobs=2, dry_run=False, state_loc=STATE_LOC, profile=False, profile_loc=PROFILE_LOC):
+    """
+    Runs the stages whose code, inputs or dependencies changed since their last successful run
+
+    :param force: the stages to run regardless of their fingerprints, 'all' for every stage
+    :param n_jobs: the number of stages that run in parallel
+    :param dry_run: only print which stages would run
+    :param state_loc: the .json file with the fingerprints of the last runs
+    :param profile: whether to measure the costs of each stage that runs
+    :param profile_loc: the .json file to save the profiles of the stages in
+    """
+
+    state = load_state(state_loc)
+    failed = []
+    planned = []
+    profiles = dict()
+
+    for level in stage_levels(list(STAGES)):
+
+        # Decide which stages of this level are out of date, now that the previous levels have finished
+        fingerprints = {name: stage_fingerprint(name, state['files']) for name in level}
+        to_run = []
+        for name in level:
+            outputs_missing = any(not os.path.exists(path) for path in STAGES[name]['outputs'])
+            deps_failed = any(dep in failed for dep in STAGES[name]['deps'])
+            if deps_failed:
+                print(f"Skipping {name}, a stage it depends on failed.")
+                failed.append(name)
+            elif ('all' in force or name in force or outputs_missing or state['stages'].get(name) != fingerprints[name]
+                  or any(dep in planned for dep in STAGES[name]['deps'])):
+                to_run.append(name)
+            else:
+                print(f"{name} is up to date.")
+
+        # Without running, the outputs do not change, so stages after a planned stage are planned as well
+        if dry_run:
+            for name in to_run:
+                print(f"{name} would run.")
+            planned.extend(to_run)
+            continue
+
+        if not to_run:
+            continue
+
+        # Run the out of date stages of this level in parallel, each in its own process,
+        # so a stage gets back all memory of the previous ones and its peak memory is its own
+        for begin in range(0, len(to_run), max(1, n_jobs)):
+            group = to_run[begin:begin + max(1, n_jobs)]
+            executors = {name: ProcessPoolExecutor(max_workers=1) for name in group}
+            futures = {name: executors[name].submit(run_stage, name, profile) for name in group}
+            for name, future in futures.items():
+                try:
+                    stats = future.result()
+                # A stage that exits, for example on an argument error, fails on its own like any other error
+                except BaseException as e:
+                    print(f"{name} failed: {e!r}")
+                    failed.append(name)
+                    continue
+                finally:
+                    executors[name].shutdown()
+
+                # Record the fingerprint the stage ran with, so it is skipped until something changes
+                state['stages'][name] = fingerprints[name]
+                if stats:
+                    profiles[name] = stats
+                print(f"{name} done.")
+
+        save_state(state, state_loc)
+
+    if profile and profiles:
+        profiling.write_report(profiles, profile_loc)
+
+    if failed:
+        raise RuntimeError(f"These stages failed or were skipped: {', '.join(failed)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the pipeline stages that are out of date.")
+    parser.add_argument('--force', nargs='+', default=[], choices=list(STAGES) + ['all'],
+                        help="Run these stages even if they are up to date")
+    parser.add_argument('--jobs', type=int, default=2, help="The number of stages that run in parallel")
+    parser.add_argument('--dry-run', action='store_true', help="Only print which stages would run")
+    parser.add_argument('--profile', action='store_true', default=profiling.ENABLED,
+                        help="Measure time and memory per stage and of the hot functions, also enabled by NEN_PROFILE=1")
+    args = parser.parse_args()
+
+    run_pipeline(args.force, args.jobs, args.dry_run, profile=args.profile)
+
+
+if __name__ == "__main__":
+    main()
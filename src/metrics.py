@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+
+
+def encode_labels(gold_labels, system_preds):
+    """
+    Encodes the gold labels and the predictions of all systems as integer arrays
+
+    :param gold_labels: the gold KvK-numbers of the test samples
+    :param system_preds: dict mapping each system to its predictions
+    :return: the number of distinct labels, the encoded gold labels and a dict with the encoded predictions
+    """
+
+    # Give every label that occurs in the gold data or in any of the predictions its own integer
+    label_ids = dict()
+    gold = np.array([label_ids.setdefault(str(label), len(label_ids)) for label in gold_labels])
+    preds = dict()
+    for system, predictions in system_preds.items():
+        preds[system] = np.array([label_ids.setdefault(str(label), len(label_ids)) for label in predictions])
+
+    return len(label_ids), gold, preds
+
+
+def resample_weights(n_samples, n_resamples, rng):
+    """Draws bootstrap resamples as a matrix with the number of times each sample was drawn"""
+
+    draws = rng.integers(0, n_samples, size=(n_resamples, n_samples))
+    draws += n_samples * np.arange(n_resamples)[:, None]
+    counts = np.bincount(draws.ravel(), minlength=n_resamples * n_samples)
+
+    return counts.reshape(n_resamples, n_samples).astype(np.float64)
+
+
+def f1_scores(weights, gold, pred, n_labels):
+    """
+    Computes micro, macro and weighted F1 for each row of sample weights at once
+
+    Follows sklearn's classification_report: the averages are taken over the labels that occur
+    in the gold labels or the predictions, and labels that are never predicted get an F1 of 0.
+
+    :param weights: matrix (resamples x samples) with the weight of every sample in each resample
+    :param gold: the encoded gold labels
+    :param pred: the encoded predictions
+    :param n_labels: the number of distinct labels
+    :return: dict mapping 'micro', 'macro' and 'weighted' to an array with one score per resample
+    """
+
+    # One-hot matrices of the gold labels, the predictions and the correct predictions
+    samples = np.arange(len(gold))
+    gold_onehot = np.zeros((len(gold), n_labels))
+    gold_onehot[samples, gold] = 1
+    pred_onehot = np.zeros((len(pred), n_labels))
+    pred_onehot[samples, pred] = 1
+    correct_onehot = gold_onehot * (gold == pred)[:, None]
+
+    # Support, number of predictions and true positives per label in each resample
+    support = weights @ gold_onehot
+    predicted = weights @ pred_onehot
+    true_pos = weights @ correct_onehot
+
+    # F1 per label, for the labels that occur in the resample
+    present = (support + predicted) > 0
+    f1 = np.divide(2 * true_pos, support + predicted, out=np.zeros_like(true_pos), where=present)
+
+    return {'micro': true_pos.sum(axis=1) / weights.sum(axis=1),
+            'macro': f1.sum(axis=1) / present.sum(axis=1),
+            'weighted': (f1 * support).sum(axis=1) / support.sum(axis=1)}
+
+
+def bootstrap_report(gold_labels, system_preds, reference='el_system', n_resamples=10000, alpha=0.05,
+                     seed=1, chunk_size=1000):
+    """
+    Computes bootstrap confidence intervals of the F1 scores of all systems, and paired
+    bootstrap significance of the differences between the reference system and the others
+
+    :param gold_labels: the gold KvK-numbers of the test samples
+    :param system_preds: dict mapping each system to its predictions
+    :param reference: the system the other systems are compared to
+    :param n_resamples: the number of bootstrap resamples
+    :param alpha: the significance level of the confidence intervals
+    :param seed: the seed of the random number generator, for reproducible resamples
+    :param chunk_size: the number of resamples that are scored at once
+    :return: a dataframe with a row per system and metric
+    :rtype: pandas.core.frame.DataFrame
+    """
+
+    # Prepare variables
+    n_labels, gold, preds = encode_labels(gold_labels, system_preds)
+    rng = np.random.default_rng(seed)
+    metrics = ['micro', 'macro', 'weighted']
+
+    # Scores on the full test set
+    full_weights = np.ones((1, len(gold)))
+    observed = {system: f1_scores(full_weights, gold, pred, n_labels) for system, pred in preds.items()}
+
+    # Score all systems on the same resamples, so that the differences are paired
+    scores = {system: {metric: [] for metric in metrics} for system in preds}
+    for begin in range(0, n_resamples, chunk_size):
+        weights = resample_weights(len(gold), min(chunk_size, n_resamples - begin), rng)
+        for system, pred in preds.items():
+            for metric, values in f1_scores(weights, gold, pred, n_labels).items():
+                scores[system][metric].append(values)
+
+    # Summarise the scores and the differences with the reference system
+    rows = []
+    quantiles = [alpha / 2, 1 - alpha / 2]
+    for system in preds:
+        for metric in metrics:
+            resampled = np.concatenate(scores[system][metric])
+            row = {'system': system,
+                   'metric': metric,
+                   'score': observed[system][metric][0],
+                   'ci_low': np.quantile(resampled, quantiles[0]),
+                   'ci_high': np.quantile(resampled, quantiles[1])}
+
+            # The p-value is the fraction of resamples in which the reference system does not do better
+            if system != reference and reference in preds:
+                diff = np.concatenate(scores[reference][metric]) - resampled
+                row['diff'] = observed[reference][metric][0] - row['score']
+                row['diff_low'] = np.quantile(diff, quantiles[0])
+                row['diff_high'] = np.quantile(diff, quantiles[1])
+                row['p_value'] = np.mean(diff <= 0)
+
+            rows.append(row)
+
+    return pd.DataFrame(rows)
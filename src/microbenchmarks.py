@@ -0,0 +1,239 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import timeit
+
+import pandas as pd
+import spacy
+
+from gazetteer import Gazetteer
+from prodigy_reader import read_jsonl
+from utils import clean_element, string_to_list, strings_to_lists, get_orgs, load_companies, load_news
+
+
+def time_function(function, *args, repeat=5):
+    """Returns the fastest of several timed runs of a function, in seconds"""
+
+    return min(timeit.repeat(lambda: function(*args), number=1, repeat=repeat))
+
+
+def parse_per_element(series, unique=False):
+    """The way preprocessing parsed org and name lists before: string_to_list, then clean_element on every element again"""
+
+    lists = [[clean_element(element) for element in elements] for elements in string_to_list(series)]
+    if unique:
+        return [list(set(elements)) for elements in lists]
+
+    return lists
+
+
+def benchmark_string_to_list(n_rows=100000, companies_loc='../data/model_data/prepro_companies.tsv', seed=1):
+    """
+    Compares strings_to_lists to string_to_list on the stringified company names, and on longer
+    lists of company names like the organisations in the news data
+
+    Both the parse alone and the former preprocessing of the lists (parsing and cleaning every element
+    again, then removing repeated names) are timed.
+
+    :param n_rows: the number of stringified lists to parse
+    :param companies_loc: the .tsv file with the company names
+    :param seed: the seed for sampling the longer lists
+    """
+
+    # Prepare the inputs, the company names are repeated to reach the number of rows
+    companies = pd.read_csv(companies_loc, sep='\t', usecols=['name', 'all_names'])
+    all_names = list(companies['all_names']) * (n_rows // len(companies) + 1)
+    rng = random.Random(seed)
+    names = list(companies['name'].astype(str))
+    orgs = [str(rng.sample(names, rng.randint(1, 20))) for _ in range(n_rows)]
+
+    for label, series in [('all_names', all_names[:n_rows]), ('orgs', orgs)]:
+
+        # Both implementations should give the same lists
+        assert strings_to_lists(series) == string_to_list(series)
+        assert ([sorted(elements) for elements in strings_to_lists(series, unique=True)] ==
+                [sorted(elements) for elements in parse_per_element(series, unique=True)])
+
+        loop_time = time_function(string_to_list, series)
+        fast_time = time_function(strings_to_lists, series)
+        print(f"string_to_list on {n_rows} {label} rows: {loop_time:.3f} s")
+        print(f"strings_to_lists on {n_rows} {label} rows: {fast_time:.3f} s ({loop_time / fast_time:.2f}x faster)")
+
+        loop_time = time_function(parse_per_element, series, True)
+        fast_time = time_function(strings_to_lists, series, True)
+        print(f"Former parse and clean of {n_rows} {label} rows: {loop_time:.3f} s")
+        print(f"strings_to_lists(unique=True) on {n_rows} {label} rows: {fast_time:.3f} s "
+              f"({loop_time / fast_time:.2f}x faster)")
+
+
+def detection_scores(found_orgs, reference_orgs):
+    """
+    Computes the precision and recall of detected mention texts against reference mention texts, per article
+
+    :param found_orgs: the detected mentions of each article
+    :param reference_orgs: the reference mentions of each article, such as those of get_orgs
+    :return: the precision and the recall
+    """
+
+    n_found = n_reference = n_shared = 0
+    for found, reference in zip(found_orgs, reference_orgs):
+        found = set(org.text for org in found)
+        reference = set(org.text for org in reference)
+        n_found += len(found)
+        n_reference += len(reference)
+        n_shared += len(found & reference)
+
+    precision = n_shared / n_found if n_found else 0.0
+    recall = n_shared / n_reference if n_reference else 0.0
+
+    return precision, recall
+
+
+def benchmark_gazetteer(n_articles=500, model_loc='../resources/nen_nlp', kb_loc='../resources/kb_initial', seed=1):
+    """
+    Compares the gazetteer mention detector to spaCy NER (get_orgs) on the same news articles
+
+    Two gazetteers are compared: one with the KB aliases, which keep the case of the news articles, and
+    one that also has the lowercased company names and ignores case. The precision and recall of their
+    mentions are measured against the NER mentions.
+
+    :param n_articles: the number of sampled news articles to detect mentions in
+    :param model_loc: the spaCy pipeline used for NER
+    :param kb_loc: the Knowledge Base with the aliases
+    :param seed: the seed for sampling the articles
+    """
+
+    from spacy.kb import KnowledgeBase
+
+    companies = load_companies(columns=['all_names'])
+    news = load_news(columns=['full_text'])
+    articles = list(news['full_text'].dropna().sample(min(n_articles, len(news)), random_state=seed))
+    nlp = spacy.load(model_loc)
+    kb = KnowledgeBase(vocab=nlp.vocab, entity_vector_length=96)
+    kb.load_bulk(kb_loc)
+
+    # Detect the mentions with NER, the reference for the gazetteers
+    start = timeit.default_timer()
+    ner_orgs = [get_orgs(article, nlp) for article in articles]
+    ner_time = timeit.default_timer() - start
+    print(f"get_orgs on {len(articles)} articles: {ner_time:.2f} s ({len(articles) / ner_time:.1f} articles/s), "
+          f"{sum(len(orgs) for orgs in ner_orgs)} mentions")
+
+    for label, kwargs in [('KB aliases', dict()),
+                          ('KB aliases + company names, ignoring case', dict(companies=companies, ignore_case=True))]:
+
+        # Compile the names into the automaton
+        start = timeit.default_timer()
+        gazetteer = Gazetteer.from_kb(kb, **kwargs)
+        print(f"{label}: compiled {gazetteer.n_names} names into {len(gazetteer.goto)} states in "
+              f"{timeit.default_timer() - start:.1f} s")
+
+        start = timeit.default_timer()
+        gazetteer_orgs = [gazetteer.find_orgs(article) for article in articles]
+        gazetteer_time = timeit.default_timer() - start
+
+        start = timeit.default_timer()
+        n_passed = sum(gazetteer.contains_any(article) for article in articles)
+        prefilter_time = timeit.default_timer() - start
+
+        precision, recall = detection_scores(gazetteer_orgs, ner_orgs)
+        print(f"{label}: find_orgs on {len(articles)} articles: {gazetteer_time:.2f} s "
+              f"({len(articles) / gazetteer_time:.1f} articles/s, {ner_time / gazetteer_time:.1f}x faster), "
+              f"{sum(len(orgs) for orgs in gazetteer_orgs)} mentions, "
+              f"precision {precision:.3f} and recall {recall:.3f} against get_orgs")
+        print(f"{label}: contains_any passes {n_passed} of {len(articles)} articles in {prefilter_time:.2f} s")
+
+
+def write_synthetic_export(path, n_records, seed=1):
+    """Writes a Prodigy export with the fields and sizes of the annotation data, with random values"""
+
+    rng = random.Random(seed)
+    sessions = ['annotations3-Jona', 'annotations-Rogier', 'iaa2-Jona', 'iaa-Rogier']
+    words = ['bedrijf', 'omzet', 'groei', 'Amsterdam', 'bv', 'nieuws', 'markt', 'ING', 'Shell', 'ëën']
+    with open(path, 'w', encoding='utf8') as outfile:
+        for n in range(n_records):
+            article = ' '.join(rng.choices(words, k=500))
+            record = {'html': f"Bedrijf: <b>ING</b>\n\n{article[:2000]}", 'org': 'ING', 'article': article,
+                      'title': ' '.join(rng.choices(words, k=8)), 'intro': ' '.join(rng.choices(words, k=40)),
+                      'slice': article[:500], 'loc_begin': 10, 'loc_end': 13,
+                      'options': [{'id': str(rng.randrange(10 ** 8)), 'html': ' '.join(rng.choices(words, k=20))}
+                                  for _ in range(5)],
+                      '_input_hash': rng.randrange(-2 ** 31, 2 ** 31), '_task_hash': rng.randrange(-2 ** 31, 2 ** 31),
+                      '_session_id': rng.choice(sessions), 'answer': rng.choice(['accept', 'accept', 'reject']),
+                      'accept': [str(rng.randrange(10 ** 8))]}
+            outfile.write(json.dumps(record) + '\n')
+
+
+def read_per_line(path, fields, session):
+    """The way the annotation tools read exports before: decode every line with json.loads and filter"""
+
+    records = []
+    with open(path, 'r', encoding='utf8') as jsonfile:
+        for line in jsonfile:
+            sample = json.loads(line)
+            if sample['_session_id'] == session and sample['answer'] == 'accept':
+                records.append({field: sample.get(field) for field in fields})
+
+    return records
+
+
+def benchmark_prodigy_reader(n_records=20000):
+    """
+    Compares read_jsonl to decoding every line with json.loads, on a synthetic Prodigy export
+
+    :param n_records: the number of records in the synthetic export
+    """
+
+    fields = ['_input_hash', 'accept', 'org']
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'export.jsonl')
+        write_synthetic_export(path, n_records)
+        print(f"Synthetic export with {n_records} records: {os.path.getsize(path) / 1024 ** 2:.1f} MB")
+
+        # All readers should give the same records
+        expected = read_per_line(path, fields, 'iaa2-Jona')
+        variants = [('read_jsonl with json.loads', dict(decode=json.loads)),
+                    ('read_jsonl', dict())]
+        for label, kwargs in variants:
+            assert list(read_jsonl(path, fields, ['iaa2-Jona'], ['accept'], **kwargs)) == expected
+
+        loop_time = time_function(read_per_line, path, fields, 'iaa2-Jona', repeat=3)
+        print(f"json.loads per line, filter one session: {loop_time:.3f} s")
+        for label, kwargs in variants:
+            fast_time = time_function(lambda: list(read_jsonl(path, fields, ['iaa2-Jona'], ['accept'], **kwargs)),
+                                      repeat=3)
+            print(f"{label}, filter one session: {fast_time:.3f} s ({loop_time / fast_time:.2f}x faster)")
+
+        # Without a filter, only the decoder makes a difference
+        full_time = time_function(lambda: [json.loads(line) for line in open(path, 'rb')], repeat=3)
+        fast_time = time_function(lambda: list(read_jsonl(path)), repeat=3)
+        print(f"json.loads per line, all records: {full_time:.3f} s")
+        print(f"read_jsonl, all records: {fast_time:.3f} s ({full_time / fast_time:.2f}x faster)")
+
+
+BENCHMARKS = {'string_to_list': lambda args: benchmark_string_to_list(args.rows),
+              'gazetteer': lambda args: benchmark_gazetteer(args.articles),
+              'prodigy_reader': lambda args: benchmark_prodigy_reader(args.records)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the microbenchmarks of the helper functions.")
+    parser.add_argument('benchmarks', nargs='*',
+                        help=f"The benchmarks to run, all if omitted: {', '.join(BENCHMARKS)}")
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--articles', type=int, default=500)
+    parser.add_argument('--records', type=int, default=20000)
+    args = parser.parse_args()
+
+    unknown = [benchmark for benchmark in args.benchmarks if benchmark not in BENCHMARKS]
+    if unknown:
+        parser.error(f"Unknown benchmarks: {', '.join(unknown)}")
+
+    for benchmark in args.benchmarks or BENCHMARKS:
+        BENCHMARKS[benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import argparse
+import csv
+import hashlib
+import json
+import mmap
+import os
+
+import numpy as np
+
+from prediction_cache import file_stats
+
+# The options every annotation task gets besides the candidates
+NIL_OPTIONS = [{"id": "NIL_notanorg", "text": "Herkende 'bedrijf' is geen bedrijf."},
+               {"id": "NIL_otherentity", "text": "Bedrijf staat niet in de opties."},
+               {"id": "NIL_ambiguous", "text": "Niet genoeg context."}]
+
+
+def nil_options():
+    """Returns new copies of the NIL options, so tasks do not share the option dicts"""
+
+    return [dict(option) for option in NIL_OPTIONS]
+
+
+INDEX_DTYPE = np.dtype([('hash', '<u8'), ('offset', '<u8'), ('length', '<u4'), ('n_candidates', '<u4')])
+
+
+def alias_hash(alias):
+    """Hashes an alias to a 64-bit integer, the same in every process and Python version"""
+
+    return int.from_bytes(hashlib.blake2b(alias.encode('utf8'), digest_size=8).digest(), 'little')
+
+
+def load_entity_info(entity_loc):
+    """Reads the name, SBI-code description and SBI-code of every KvK-number from entities.tsv"""
+
+    id_dict = dict()
+    with open(entity_loc, "r", encoding="utf8") as csvfile:
+        csvreader = csv.reader(csvfile, delimiter="\t")
+        for row in csvreader:
+            id_dict[row[0]] = (row[1], row[2], row[3])
+
+    return id_dict
+
+
+def candidate_html(kvk, id_dict):
+    """ For each candidate company entity, create a links to websites with extra information them """
+
+    # Get name, SBI-code and SBI-code description from the id_dict for the KvK-number of each candidate
+    name = id_dict[kvk][0]
+    desc = id_dict[kvk][1]
+    sbi_code = id_dict[kvk][2]
+    sbi = str(int(float(sbi_code)))
+
+    # Create URL to CBS page with explanation of SBI-code
+    base_sbi_url = "https://sbi.cbs.nl/cbs.typeermodule.typeerservicewebapi/content/angular/app/#/code?sbicode="
+    sbi_url = base_sbi_url+sbi
+    sbi_url = f"<a href='{sbi_url}' target='_blank'>{desc}</a>"
+
+    # Create URL to query the Kamer van Koophandel Handelsregister with the KvK-number of the candidate
+    kvk_link = "https://www.kvk.nl/zoeken/handelsregister/?kvknummer=" + kvk
+    kvk_url = f"<a href='{kvk_link}' target='_blank'>{kvk}</a>"
+
+    option = f"{name}: {sbi_url} (KvK: {kvk_url})"
+    return option
+
+
+def build_option_cache(kb, id_dict, out_dir, min_candidates=2, kb_loc=None, entity_loc=None):
+    """
+    Precomputes the annotation options of every alias in the Knowledge Base
+
+    The options of each alias are stored as a JSON record in one binary file, and an index sorted by
+    alias hash holds the offset and length of each record, so a lookup is a binary search and one read.
+
+    :param kb: the Knowledge Base that generates the candidates
+    :param id_dict: the name, SBI-code description and SBI-code of every KvK-number
+    :param out_dir: the directory to save the cache in
+    :param min_candidates: only aliases with at least this many candidates are annotated and stored
+    :param kb_loc: the directory the Knowledge Base was loaded from, to detect when the cache is outdated
+    :param entity_loc: the entities.tsv file the id_dict was read from, to detect when the cache is outdated
+    """
+
+    os.makedirs(out_dir, exist_ok=True)
+    entries = []
+    offset = 0
+    with open(os.path.join(out_dir, 'options.bin'), 'wb') as outfile:
+        for alias in kb.get_alias_strings():
+            candidates = kb.get_candidates(alias)
+            if len(candidates) < min_candidates:
+                continue
+
+            options = [{"id": c.entity_, "html": candidate_html(c.entity_, id_dict)} for c in candidates]
+            record = json.dumps({'alias': alias, 'options': options}, ensure_ascii=False).encode('utf8')
+            outfile.write(record)
+            entries.append((alias_hash(alias), offset, len(record), len(candidates)))
+            offset += len(record)
+
+    index = np.array(entries, dtype=INDEX_DTYPE)
+    index.sort(order='hash')
+    np.save(os.path.join(out_dir, 'index.npy'), index)
+
+    meta = {'kb_stats': file_stats(kb_loc) if kb_loc else None,
+            'entity_stats': file_stats(entity_loc) if entity_loc else None}
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as outfile:
+        json.dump(meta, outfile)
+
+    print(f"Saved the options of {len(index)} aliases in {out_dir}")
+
+
+class OptionCache:
+    """Looks up the precomputed options of an alias in a memory-mapped option cache"""
+
+    def __init__(self, path):
+        meta_loc = os.path.join(path, 'meta.json')
+        self.meta = dict()
+        if os.path.exists(meta_loc):
+            with open(meta_loc) as infile:
+                self.meta = json.load(infile)
+
+        self.index = np.load(os.path.join(path, 'index.npy'), mmap_mode='r')
+        self.hashes = self.index['hash']
+        self._file = open(os.path.join(path, 'options.bin'), 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self.blob = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+    def get(self, alias):
+        """
+        Returns the candidate options of an alias
+
+        :param alias: the company mention
+        :return: list of options with the KvK-number as id and the rendered html, or None if the alias is not stored
+        """
+
+        key = np.uint64(alias_hash(alias))
+        position = int(np.searchsorted(self.hashes, key))
+
+        # Aliases with the same hash are next to each other, the stored alias tells them apart
+        while position < len(self.hashes) and self.hashes[position] == key:
+            entry = self.index[position]
+            record = json.loads(self.blob[int(entry['offset']):int(entry['offset']) + int(entry['length'])])
+            if record['alias'] == alias:
+                return record['options']
+            position += 1
+
+        return None
+
+    def __contains__(self, alias):
+        return self.get(alias) is not None
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def is_current(self, kb_loc, entity_loc):
+        """Checks whether the Knowledge Base and entities.tsv are unchanged since the cache was built"""
+
+        return (os.path.exists(kb_loc) and os.path.exists(entity_loc)
+                and self.meta.get('kb_stats') == file_stats(kb_loc)
+                and self.meta.get('entity_stats') == file_stats(entity_loc))
+
+    def close(self):
+        if isinstance(self.blob, mmap.mmap):
+            self.blob.close()
+        self._file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precomputes the annotation options of the KB aliases for the Prodigy recipes.")
+    parser.add_argument('--nlp', default='resources/nen_nlp')
+    parser.add_argument('--kb', default='resources/kb_initial')
+    parser.add_argument('--entities', default='../data/model_data/entities.tsv')
+    parser.add_argument('--output', default='../data/prodigy_data/option_cache')
+    args = parser.parse_args()
+
+    # spaCy is only needed to build the cache, the recipes that read it do not import it
+    import spacy
+    from spacy.kb import KnowledgeBase
+
+    nlp = spacy.load(args.nlp)
+    kb = KnowledgeBase(vocab=nlp.vocab, entity_vector_length=96)
+    kb.load_bulk(args.kb)
+    build_option_cache(kb, load_entity_info(args.entities), args.output, kb_loc=args.kb, entity_loc=args.entities)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+
+
+def file_stats(path):
+    """Returns the size and modification time of a file, or of every file in a directory"""
+
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return [[stat.st_size, stat.st_mtime_ns]]
+
+    stats = []
+    for root, dirs, filenames in os.walk(path):
+        dirs.sort()
+        for filename in sorted(filenames):
+            stat = os.stat(os.path.join(root, filename))
+            stats.append([os.path.relpath(os.path.join(root, filename), path), stat.st_size, stat.st_mtime_ns])
+
+    return stats
+
+
+def fingerprint_path(path):
+    """
+    Computes a content hash of a file, or of all files in a directory
+
+    :param path: path to a file or directory, such as a spaCy model or a Knowledge Base
+    :return: the hexadecimal SHA-256 digest
+    :rtype: str
+    """
+
+    digest = hashlib.sha256()
+
+    # Hash the files of a directory in a fixed order, together with their relative paths
+    if os.path.isdir(path):
+        files = []
+        for root, dirs, filenames in os.walk(path):
+            dirs.sort()
+            files.extend(os.path.join(root, filename) for filename in sorted(filenames))
+    else:
+        files = [path]
+
+    for file in files:
+        digest.update(os.path.relpath(file, path).encode('utf8'))
+        with open(file, 'rb') as infile:
+            for block in iter(lambda: infile.read(1 << 20), b''):
+                digest.update(block)
+
+    return digest.hexdigest()
+
+
+def fingerprint_source(*objects):
+    """Computes a hash of the source code of the functions and modules that make up a system"""
+
+    digest = hashlib.sha256()
+    for obj in objects:
+        digest.update(inspect.getsource(obj).encode('utf8'))
+
+    return digest.hexdigest()
+
+
+def combine_fingerprints(*fingerprints):
+    """Combines several fingerprints into one"""
+
+    return hashlib.sha256('\t'.join(fingerprints).encode('utf8')).hexdigest()
+
+
+def row_key(sample):
+    """Computes the key of a test sample from its article and the offsets of the mention"""
+
+    text, small_context, offset = sample
+    return hashlib.sha256(json.dumps([text, list(offset)]).encode('utf8')).hexdigest()
+
+
+class PredictionCache:
+    """
+    Stores the predictions of each system per input row, keyed by a fingerprint of the system
+
+    A changed fingerprint (other model, KB, company data or code) invalidates all predictions
+    of that system, while unchanged systems are served from the cache.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS predictions (
+                                   system TEXT, fingerprint TEXT, row_key TEXT, prediction TEXT,
+                                   PRIMARY KEY (system, fingerprint, row_key))""")
+
+    def get(self, system, fingerprint, row_keys):
+        """Returns a dict mapping the cached row keys of a system to their predictions"""
+
+        cached = dict()
+        unique_keys = list(set(row_keys))
+
+        # Query in chunks, SQLite limits the number of parameters per statement
+        for begin in range(0, len(unique_keys), 500):
+            chunk = unique_keys[begin:begin + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connection.execute(f"""SELECT row_key, prediction FROM predictions
+                                               WHERE system = ? AND fingerprint = ? AND row_key IN ({placeholders})""",
+                                           [system, fingerprint] + chunk)
+            cached.update(rows)
+
+        return cached
+
+    def put(self, system, fingerprint, predictions):
+        """Stores a dict mapping row keys to the predictions of a system, and drops outdated predictions"""
+
+        with self.connection:
+            self.connection.execute("DELETE FROM predictions WHERE system = ? AND fingerprint != ?",
+                                    (system, fingerprint))
+            self.connection.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)",
+                                        [(system, fingerprint, key, prediction)
+                                         for key, prediction in predictions.items()])
+
+    def close(self):
+        self.connection.close()
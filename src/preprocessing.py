@@ -1,5 +1,9 @@
+import argparse
+import os
 import pandas as pd
-from utils import string_to_list, clean_element
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from utils import strings_to_lists, clean_elements, save_table, clear_table, next_part
 
 
 def get_intro(title, article):
@@ -54,28 +58,31 @@ def merge_title_text(title, text):
     return new_text
 
 
-def preprocess_orgs(orgs_series):
-    """Reformats and cleans a series containing lists"""
+def clean_news(news):
+    """
+    Cleans a dataframe of raw news articles
 
-    # Prepare container
-    series = []
-    for orgs in orgs_series:
+    :param news: the raw news articles, or a chunk of them
+    :return: the preprocessed news articles and the extraction timestamps of the kept articles
+    """
 
-        # Prepare list for each entry
-        org_list = []
-        for org in orgs:
+    # Make sure every article has a title and the full text is accessible
+    news.dropna(subset=['title', 'full_text', 'orgs'], inplace=True)
+    # Clean company names of unwanted characters and delete multiple occurrences of the same org
+    news['orgs'] = strings_to_lists(news['orgs'], unique=True)
 
-            # Clean organization name and add it to org list
-            clean_org = clean_element(org)
-            org_list.append(clean_org)
+    # Find data span
+    dates = news['extraction_timestamp']
 
-        # Delete multiple occurrences of same org
-        org_list = list(set(org_list))
+    # Merge title to the full article text
+    news['intro'] = [get_intro(title, text) for title, text in zip(news['title'], news['full_text'])]
+    news.dropna(subset=['intro'], inplace=True)
+    news['full_text'] = [merge_title_text(title, text) for title, text in zip(news['title'], news['full_text'])]
 
-        # Add all org lists together
-        series.append(org_list)
+    # Remove columns that are not used
+    news.drop(news.columns.difference(['full_text', 'title', 'orgs', 'url', 'intro']), 1, inplace=True)
 
-    return series
+    return news, dates
 
 
 def preprocess_news(news_path):
@@ -87,29 +94,84 @@ def preprocess_news(news_path):
 
     # Read in news data and transform strings that are lists back to lists
     news = pd.read_csv(news_path, sep='\t')
-
-    # Make sure every article has a title and the full text is accessible
-    news.dropna(subset=['title', 'full_text', 'orgs'], inplace=True)
-    news['orgs'] = string_to_list(news['orgs'])
-
-    # Clean company names of unwanted characters
-    news['orgs'] = preprocess_orgs(news['orgs'])
+    news, dates = clean_news(news)
 
     # Find data span
-    dates = news['extraction_timestamp']
     sorted_dates = dates.sort_values()
     print(f"Earliest date: {sorted_dates.iloc[0]}")
     print(f"Latest date: {sorted_dates.iloc[-1]}")
 
-    # Merge title to the full article text
-    news['intro'] = [get_intro(title, text) for title, text in zip(news['title'], news['full_text'])]
-    news.dropna(subset=['intro'], inplace=True)
-    news['full_text'] = [merge_title_text(title, text) for title, text in zip(news['title'], news['full_text'])]
+    return news
 
-    # Remove columns that are not used
-    news.drop(news.columns.difference(['full_text', 'title', 'orgs', 'url', 'intro']), 1, inplace=True)
 
-    return news
+def clean_news_chunk(news):
+    """Cleans a chunk of news articles and returns it with its earliest and latest date"""
+
+    news, dates = clean_news(news)
+    dates = dates.dropna()
+
+    return news, (dates.min() if len(dates) else None), (dates.max() if len(dates) else None)
+
+
+def preprocess_news_chunked(news_path, out_path, chunksize=10000, n_workers=1, parquet_path=None):
+    """
+    Preprocesses the news database in chunks and appends each preprocessed chunk to the output file,
+    so the news database never has to fit in memory at once
+
+    :param news_path: path to the raw news database
+    :param out_path: path to save the preprocessed news database
+    :param parquet_path: the Parquet dataset directory to also save each chunk in as a part file
+    :param chunksize: the number of articles per chunk
+    :param n_workers: the number of processes that clean chunks in parallel
+    :return: the number of preprocessed news articles
+    """
+
+    # Prepare variables
+    chunks = pd.read_csv(news_path, sep='\t', chunksize=chunksize)
+    earliest = None
+    latest = None
+    n_articles = 0
+    n_chunks = 0
+    if parquet_path:
+        clear_table(parquet_path)
+
+    def save(result):
+        """Appends a cleaned chunk to the output file and updates the data span"""
+
+        nonlocal earliest, latest, n_articles, n_chunks
+        news, chunk_earliest, chunk_latest = result
+        news.to_csv(out_path, sep='\t', mode='w' if n_articles == 0 else 'a', header=n_articles == 0)
+        if parquet_path:
+            save_table(news, parquet_path, part=n_chunks)
+        n_articles += news.shape[0]
+        n_chunks += 1
+        print(f"{n_articles} news articles preprocessed.")
+
+        if chunk_earliest is not None and (earliest is None or chunk_earliest < earliest):
+            earliest = chunk_earliest
+        if chunk_latest is not None and (latest is None or chunk_latest > latest):
+            latest = chunk_latest
+
+    if n_workers == 1:
+        for chunk in chunks:
+            save(clean_news_chunk(chunk))
+
+    # Keep at most two chunks per worker in flight, and write them in their original order
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(clean_news_chunk, chunk))
+                if len(pending) >= 2 * n_workers:
+                    save(pending.popleft().result())
+            while pending:
+                save(pending.popleft().result())
+
+    # Print data span
+    print(f"Earliest date: {earliest}")
+    print(f"Latest date: {latest}")
+
+    return n_articles
 
 
 def merge_names(alt_names, first_names):
@@ -118,21 +180,12 @@ def merge_names(alt_names, first_names):
     # Prepare container
     all_comp_names = []
 
-    # Go through first name and alternative names of companies
-    for alt_names, first_name in zip(alt_names, first_names):
-        all_names = []
-
-        # Clean first name and add it to all names list
-        clean_first_name = clean_element(first_name)
-        all_names.append(clean_first_name)
-
-        # Clean each alternative name and add it to all names list
-        for name in alt_names:
-            clean_name = clean_element(name)
-            all_names.append(clean_name)
+    # Go through first name and alternative names of companies, the alternative names were cleaned when
+    # they were parsed, the first names are cleaned all at once
+    for alt_names, first_name in zip(alt_names, clean_elements(first_names)):
 
         # Delete multiple occurrences of same names
-        all_names = list(set(all_names))
+        all_names = list(set([first_name] + alt_names))
         all_comp_names.append(all_names)
 
     return all_comp_names
@@ -184,7 +237,7 @@ def preprocess_companies(companies_path):
     # Update outdated KvK-numbers
     companies['kvk_number'] = companies['kvk_number'].apply(update_kvk)
 
-    companies['alternative_names'] = string_to_list(companies['alternative_names'])
+    companies['alternative_names'] = strings_to_lists(companies['alternative_names'])
 
     # Make sure all companies have a sbi_code_description
     companies.dropna(subset=['sbi_code_description'], inplace=True)
@@ -200,18 +253,76 @@ def preprocess_companies(companies_path):
     return companies
 
 
-def main():
-    # Preprocess news data and save it
+def preprocess_news_delta(delta_path, prepro_path, prepro_delta_path, parquet_path=None):
+    """
+    Preprocesses only newly harvested news articles and appends them to the preprocessed news
+
+    :param delta_path: path to the raw new articles
+    :param prepro_path: path to the preprocessed news database
+    :param prepro_delta_path: path to save the preprocessed new articles, for candidate discovery
+    :param parquet_path: the Parquet dataset directory of the preprocessed news, to add a part file to
+    :return: the number of preprocessed new articles
+    """
+
+    # Nothing to do if there were no new articles
+    if pd.read_csv(delta_path, sep='\t', nrows=1).empty:
+        print("No new news articles to preprocess.")
+        return 0
+
+    prepro_delta = preprocess_news(delta_path)
+
+    # Label the new articles with their rows in the raw corpus, which the harvest wrote as the index of the
+    # delta, so they continue the index of the preprocessed news like after preprocessing the whole corpus
+    corpus_rows = pd.read_csv(delta_path, sep='\t', usecols=[0]).iloc[:, 0].to_numpy()
+    prepro_delta.index = corpus_rows[prepro_delta.index]
+    prepro_delta.to_csv(prepro_delta_path, sep='\t')
+    prepro_delta.to_csv(prepro_path, sep='\t', mode='a', header=not os.path.exists(prepro_path))
+
+    # Only add a part to an existing dataset, a dataset with just the new articles would hide the .tsv file
+    if parquet_path and os.path.isdir(parquet_path):
+        save_table(prepro_delta, parquet_path, part=next_part(parquet_path))
+    print(f"Added {prepro_delta.shape[0]} preprocessed news articles.")
+
+    return prepro_delta.shape[0]
+
+
+def main(chunksize=None, n_workers=1):
+    # Preprocess news data and save it, in chunks for news corpora that do not fit in memory
+    # The .parquet versions are read by the pipeline, the .tsv versions are kept for humans
     news_path = "../data/model_data/nen_news.tsv"
-    prepro_news = preprocess_news(news_path)
-    prepro_news.to_csv('../data/model_data/prepro_news.tsv', sep='\t')
+    if chunksize:
+        preprocess_news_chunked(news_path, '../data/model_data/prepro_news.tsv', chunksize, n_workers,
+                                '../data/model_data/prepro_news.parquet')
+    else:
+        prepro_news = preprocess_news(news_path)
+        prepro_news.to_csv('../data/model_data/prepro_news.tsv', sep='\t')
+        clear_table('../data/model_data/prepro_news.parquet')
+        save_table(prepro_news, '../data/model_data/prepro_news.parquet', part=0)
 
     # Preprocess company data and save it
     companies_path = "../data/model_data/nen_companies.tsv"
     prepro_companies = preprocess_companies(companies_path)
     save_entities(prepro_companies)
     prepro_companies.to_csv('../data/model_data/prepro_companies.tsv', sep='\t', index=False)
+    save_table(prepro_companies, '../data/model_data/prepro_companies.parquet')
+
+
+def main_delta():
+    # Preprocess only the news articles from the last harvest
+    preprocess_news_delta("../data/model_data/nen_news_delta.tsv",
+                          "../data/model_data/prepro_news.tsv",
+                          "../data/model_data/prepro_news_delta.tsv",
+                          "../data/model_data/prepro_news.parquet")
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Preprocesses the news and company data.")
+    parser.add_argument('--delta', action='store_true', help="Only preprocess the articles of the last harvest")
+    parser.add_argument('--chunksize', type=int, default=None, help="Preprocess the news in chunks of this size")
+    parser.add_argument('--workers', type=int, default=1, help="Number of processes for chunked preprocessing")
+    args = parser.parse_args()
+
+    if args.delta:
+        main_delta()
+    else:
+        main(args.chunksize, args.workers)
@@ -1,6 +1,7 @@
 import spacy
 from spacy.kb import KnowledgeBase
 from collections import defaultdict
+from progress import Progress
 
 
 def get_prior_probs(candidates, alias_dict):
@@ -54,14 +55,12 @@ def save_candidates(datapath):
     :return:
     """
     cands_dict = dict()
-    i = 0
+    progress = Progress('save_candidates', unit='samples')
     with open(datapath, 'r', encoding='utf8') as infile:
         for line in infile:
             line = line.replace('\n', '').split('\t')
             if line[0] != 'context' and line[-1] != 'NIL':
-                if i % 100 == 0:
-                    print(f"{i} samples preprocessed.")
-                i += 1
+                progress.update()
                 alias = line[2]
                 entity = line[-1]
 
@@ -70,6 +69,8 @@ def save_candidates(datapath):
 
                 cands_dict[alias][entity] += 1
 
+    progress.close(aliases=len(cands_dict))
+
     return cands_dict
 
 
@@ -13,9 +13,14 @@ from prodigy.components.loaders import JSONL
 from prodigy.util import set_hashes
 from prodigy.components.filters import filter_duplicates
 
-import csv
+import os
+import sys
 from pathlib import Path
 
+# Prodigy loads this file with -F, make the modules next to it importable
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from option_cache import OptionCache, nil_options, candidate_html, load_entity_info
+
 # Define Prodigy recipe
 @prodigy.recipe(
     "inter_annotator_agreement",
@@ -23,24 +28,33 @@ from pathlib import Path
     source=("The source data as a .txt file", "positional", None, Path),
     nlp_dir=("Path to the NLP model", "positional", None, Path),
     kb_loc=("Path to the KB", "positional", None, Path),
-    entity_loc=("Path to the file with additional information about the entities", "positional", None, Path)
+    entity_loc=("Path to the file with additional information about the entities", "positional", None, Path),
+    options_loc=("Path to the option cache made by option_cache.py, used instead of the NLP model while the KB and entities are unchanged", "option", "o", Path)
 )
-def inter_annotator_agreement(dataset, source, nlp_dir, kb_loc, entity_loc):
-    # Initialize the Prodigy stream by running the NER model
-    nlp = spacy.load(nlp_dir)
-    kb = KnowledgeBase(vocab=nlp.vocab, entity_vector_length=1)
-    kb.load_bulk(kb_loc)
-
-    # Read the pre-defined CSV file into dictionaries mapping QIDs to the full names and descriptions
-    id_dict = dict()
-    with entity_loc.open("r", encoding="utf8") as csvfile:
-        csvreader = csv.reader(csvfile, delimiter="\t")
-        for row in csvreader:
-            id_dict[row[0]] = (row[1], row[2], row[3])
-
+def inter_annotator_agreement(dataset, source, nlp_dir, kb_loc, entity_loc, options_loc=None):
     # Define stream of examples
     stream = JSONL(source)
-    stream = _add_options(stream, kb, id_dict)
+
+    # The cache is only used while the KB and entities it was built from are unchanged
+    cache = OptionCache(options_loc) if options_loc else None
+    if cache is not None and not cache.is_current(kb_loc, entity_loc):
+        print(f"Option cache {options_loc} is older than {kb_loc} or {entity_loc}, loading the KB instead.")
+        cache.close()
+        cache = None
+
+    # Join the tasks with the precomputed options, without loading the model and KB
+    if cache is not None:
+        stream = _add_cached_options(stream, cache)
+
+    else:
+        # Initialize the Prodigy stream by running the NER model
+        nlp = spacy.load(nlp_dir)
+        kb = KnowledgeBase(vocab=nlp.vocab, entity_vector_length=1)
+        kb.load_bulk(kb_loc)
+
+        # Read the pre-defined CSV file into dictionaries mapping QIDs to the full names and descriptions
+        id_dict = load_entity_info(entity_loc)
+        stream = _add_options(stream, kb, id_dict)
 
     return {
         "dataset": dataset,
@@ -62,38 +76,28 @@ def _add_options(stream, kb, id_dict):
 
         # Take only company mentions with multiple candidates
         if len(candidates) > 1:
-            options = [{"id": c.entity_, "html": _print_info(c.entity_, id_dict)} for c in candidates]
-            options.append({"id": "NIL_notanorg", "text": "Herkende 'bedrijf' is geen bedrijf."})
-            options.append({"id": "NIL_otherentity", "text": "Bedrijf staat niet in de opties."})
-            options.append({"id": "NIL_ambiguous", "text": "Niet genoeg context."})
-
-            task["options"] = options
+            options = [{"id": c.entity_, "html": candidate_html(c.entity_, id_dict)} for c in candidates]
+            task["options"] = options + nil_options()
 
             yield task
 
 
-def _print_info(kvk, id_dict):
-    """ For each candidate company entity, create a links to websites with extra information them """
-
-    # Get name, SBI-code and SBI-code description from the id_dict for the KvK-number of each candidate
-    name = id_dict[kvk][0]
-    desc = id_dict[kvk][1]
-    sbi_code = id_dict[kvk][2]
-    sbi = str(int(float(sbi_code)))
+def _add_cached_options(stream, cache):
+    """Create options for annotation from the option cache, which only holds mentions with multiple candidates"""
 
-    # Create URL to CBS page with explanation of SBI-code
-    base_sbi_url = "https://sbi.cbs.nl/cbs.typeermodule.typeerservicewebapi/content/angular/app/#/code?sbicode="
-    sbi_url = base_sbi_url+sbi
-    sbi_url = f"<a href='{sbi_url}' target='_blank'>{desc}</a>"
+    for task in stream:
+        options = cache.get(task['org'])
+        if options:
+            task["options"] = options + nil_options()
 
-    # Create URL to query the Kamer van Koophandel Handelsregister with the KvK-number of the candidate
-    kvk_link = "https://www.kvk.nl/zoeken/handelsregister/?kvknummer=" + kvk
-    kvk_url = f"<a href='{kvk_link}' target='_blank'>{kvk}</a>"
+            yield task
 
-    option = f"{name}: {sbi_url} (KvK: {kvk_url})"
-    return option
 
 """
+Copy this command in the terminal to precompute the options of all aliases, so the annotation environment starts without loading the model and KB
+python option_cache.py --nlp resources/nen_nlp --kb resources/kb_initial --entities ../data/model_data/entities.tsv --output ../data/prodigy_data/option_cache
+Then add `-o ../data/prodigy_data/option_cache` to the command below
+
 Copy this command in the terminal to start Prodigy's annotation environment
 prodigy inter_annotator_agreement inter-annotator-agreement ../prodigy/iaa_input.jsonl ../resources/nen_nlp ../resources/kb_initial ../data/entities.tsv -F prodigy_iaa.py
 
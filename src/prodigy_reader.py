@@ -0,0 +1,74 @@
+import json
+
+# orjson decodes JSON several times faster than the standard library, it is used when it is installed
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+
+def _precheck_token(value):
+    """
+    Returns the bytes a line must contain if one of its fields has this value, or None if there is no safe token
+
+    Only plain ASCII strings without characters that JSON escapes are used, those are written the same
+    by every JSON writer, so a line without the token can be skipped without decoding it.
+    """
+
+    if not isinstance(value, str):
+        return None
+
+    encoded = json.dumps(value)
+    if not encoded.isascii() or '\\' in encoded:
+        return None
+
+    return encoded.encode('ascii')
+
+
+def read_jsonl(path, fields=None, sessions=None, answers=None, where=None, decode=loads):
+    """
+    Streams the records of a Prodigy JSON lines export
+
+    The session and answer filters are pushed down: lines that cannot match are skipped with a
+    substring check before they are decoded, and the decoded records are checked exactly.
+
+    :param path: the JSON lines file
+    :param fields: only keep these fields of each record, missing fields become None, all fields if omitted
+    :param sessions: only yield records with one of these `_session_id` values
+    :param answers: only yield records with one of these `answer` values, such as 'accept'
+    :param where: an extra predicate on the full record, such as `lambda record: record['accept']`
+    :param decode: the function that decodes a line, orjson if it is installed
+    :return: generator of records as dicts
+    """
+
+    sessions = set(sessions) if sessions is not None else None
+    answers = set(answers) if answers is not None else None
+
+    # A line has to contain the token of at least one allowed value, unless some value has no safe token
+    prechecks = []
+    for values in (sessions, answers):
+        if values is not None:
+            tokens = [_precheck_token(value) for value in values]
+            if all(tokens):
+                prechecks.append(tokens)
+
+    with open(path, 'rb') as infile:
+        for line in infile:
+            if not line.strip():
+                continue
+            if prechecks and not all(any(token in line for token in tokens) for tokens in prechecks):
+                continue
+
+            record = decode(line)
+            if sessions is not None and record.get('_session_id') not in sessions:
+                continue
+            if answers is not None and record.get('answer') not in answers:
+                continue
+            if where is not None and not where(record):
+                continue
+
+            if fields is not None:
+                record = {field: record.get(field) for field in fields}
+
+            yield record
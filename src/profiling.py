@@ -0,0 +1,132 @@
+import atexit
+import functools
+import json
+import os
+import platform
+import resource
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Profiling is opt-in, set NEN_PROFILE=1 or run `python main.py --profile`
+ENABLED = os.environ.get('NEN_PROFILE', '') not in ('', '0')
+
+START = time.perf_counter()
+
+# Calls, wall time and CPU time per timed function or block in this process
+TIMERS = defaultdict(lambda: {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0})
+
+
+def peak_memory():
+    """Returns the peak resident memory of the current process in MB"""
+
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == 'Darwin':
+        return peak / 1024 ** 2
+
+    return peak / 1024
+
+
+def enable():
+    """Enables profiling in this process and in the processes it starts, call it before importing the timed modules"""
+
+    global ENABLED
+    ENABLED = True
+    os.environ['NEN_PROFILE'] = '1'
+
+
+@contextmanager
+def timer(name):
+    """Adds the wall and CPU time of a block to the timer with the given name, if profiling is enabled"""
+
+    if not ENABLED:
+        yield
+        return
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        stats = TIMERS[name]
+        stats['calls'] += 1
+        stats['wall_s'] += time.perf_counter() - wall
+        stats['cpu_s'] += time.process_time() - cpu
+
+
+def timed(function):
+    """Decorator that times every call of a function, returns the function unchanged if profiling is disabled"""
+
+    if not ENABLED:
+        return function
+
+    name = f"{function.__module__}.{function.__qualname__}"
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with timer(name):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def timer_report():
+    """Returns the timers of this process, rounded and sorted by wall time"""
+
+    return {name: {'calls': stats['calls'], 'wall_s': round(stats['wall_s'], 3), 'cpu_s': round(stats['cpu_s'], 3)}
+            for name, stats in sorted(TIMERS.items(), key=lambda item: -item[1]['wall_s'])}
+
+
+def profile_call(function, *args):
+    """
+    Runs a function and measures its costs, meant to run a pipeline stage in a fresh process
+
+    :return: the result of the function and a dict with its wall time, CPU time, peak memory and timers
+    """
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime
+    wall = time.perf_counter()
+
+    result = function(*args)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    profile = {'wall_s': round(time.perf_counter() - wall, 3),
+               'cpu_s': round(usage.ru_utime + usage.ru_stime - cpu, 3),
+               'peak_rss_mb': round(peak_memory(), 1),
+               'timers': timer_report()}
+
+    return result, profile
+
+
+def print_report(stages):
+    """Prints the costs of each stage and its slowest timed functions"""
+
+    print()
+    print(f"{'stage':<28}{'wall (s)':>12}{'cpu (s)':>12}{'peak RSS (MB)':>16}")
+    for name, profile in stages.items():
+        print(f"{name:<28}{profile['wall_s']:>12.1f}{profile['cpu_s']:>12.1f}{profile['peak_rss_mb']:>16.1f}")
+        for timer_name, stats in list(profile['timers'].items())[:5]:
+            print(f"    {timer_name:<40}{stats['calls']:>10} calls{stats['wall_s']:>12.1f} s")
+
+
+def write_report(stages, report_loc):
+    """Saves the profiles of the stages as JSON and prints a summary"""
+
+    with open(report_loc, 'w', encoding='utf8') as outfile:
+        json.dump({'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'stages': stages}, outfile, indent=2)
+
+    print_report(stages)
+    print(f"Saved the profile in {report_loc}")
+
+
+def _print_timers():
+    """Prints the timers when a profiled script is run on its own"""
+
+    if TIMERS:
+        print_report({'process': {'wall_s': time.perf_counter() - START, 'cpu_s': time.process_time(),
+                                  'peak_rss_mb': peak_memory(), 'timers': timer_report()}})
+
+
+if ENABLED:
+    atexit.register(_print_timers)
@@ -0,0 +1,84 @@
+import json
+import os
+import sys
+import time
+
+# Seconds between two progress events of a loop, and an optional file to append the events to
+INTERVAL = float(os.environ.get('NEN_PROGRESS_INTERVAL', 10))
+LOG_LOC = os.environ.get('NEN_PROGRESS_LOG')
+
+
+class Progress:
+    """
+    Tracks the progress of a long loop and emits rate-limited progress events as JSON lines
+
+    Each event holds the stage, the number of items processed, the total if known, the throughput in
+    items per second, the estimated time left and the counters of the loop. Events go to stdout, or are
+    appended to the file in NEN_PROGRESS_LOG, at most once every `interval` seconds, plus a final event
+    when the loop is done.
+
+    Usage:
+        progress = Progress('find_candidates', total=len(news), unit='articles')
+        for article in news:
+            ...
+            progress.update(mentions=len(mention_cands))
+        progress.close()
+    """
+
+    def __init__(self, stage, total=None, unit='items', interval=None):
+        self.stage = stage
+        self.total = total
+        self.unit = unit
+        self.interval = INTERVAL if interval is None else interval
+        self.count = 0
+        self.counters = dict()
+        self.start = time.perf_counter()
+        self.last_emit = self.start
+
+    def update(self, n=1, **counters):
+        """Adds n processed items and sets the given counters, emits an event if the interval has passed"""
+
+        self.count += n
+        if counters:
+            self.counters.update(counters)
+
+        now = time.perf_counter()
+        if now - self.last_emit >= self.interval:
+            self.last_emit = now
+            self.emit(now)
+
+    def event(self, now, done=False):
+        """Returns the current progress as a dict"""
+
+        elapsed = now - self.start
+        rate = self.count / elapsed if elapsed > 0 else None
+        eta = None
+        if not done and rate and self.total is not None:
+            eta = round(max(self.total - self.count, 0) / rate, 1)
+
+        return {'event': 'progress',
+                'stage': self.stage,
+                'unit': self.unit,
+                'count': self.count,
+                'total': self.total,
+                'rate': round(rate, 2) if rate else None,
+                'elapsed_s': round(elapsed, 1),
+                'eta_s': eta,
+                'done': done,
+                'counters': self.counters}
+
+    def emit(self, now, done=False):
+        """Writes a progress event as one JSON line"""
+
+        line = json.dumps(self.event(now, done), ensure_ascii=False)
+        if LOG_LOC:
+            with open(LOG_LOC, 'a', encoding='utf8') as outfile:
+                outfile.write(line + '\n')
+        else:
+            print(line, file=sys.stdout, flush=True)
+
+    def close(self, **counters):
+        """Sets the final counters and emits the final event"""
+
+        self.counters.update(counters)
+        self.emit(time.perf_counter(), done=True)
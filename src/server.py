@@ -0,0 +1,277 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import spacy
+
+from link import doc_links
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+               500: 'Internal Server Error'}
+
+
+class MicroBatcher:
+    """
+    Queues incoming texts and links them in micro-batches with nlp.pipe
+
+    A batch is flushed as soon as it holds `max_batch_size` texts, or when the oldest text in it
+    has waited `max_wait` seconds, so single requests stay fast and concurrent requests share batches.
+    """
+
+    def __init__(self, nlp, max_batch_size=32, max_wait=0.005):
+        self.nlp = nlp
+        self.kb = nlp.get_pipe('entity_linker').kb
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+
+        # A single thread runs the pipeline, so the event loop keeps accepting requests meanwhile
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        # Metrics
+        self.n_texts = 0
+        self.n_batches = 0
+        self.latencies = deque(maxlen=10000)
+        self.batch_sizes = deque(maxlen=1000)
+
+    async def link(self, text):
+        """Queues a text and waits for its links"""
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future, time.perf_counter()))
+        return await future
+
+    def _link_batch(self, texts):
+        """Runs the pipeline on a batch of texts, called in the worker thread"""
+
+        docs = self.nlp.pipe(texts, batch_size=len(texts))
+        return [list(doc_links(doc, self.kb, include_candidates=True)) for doc in docs]
+
+    def _link_each(self, texts):
+        """Links the texts of a failed batch one by one, so an error is only returned for the texts that cause it"""
+
+        results = []
+        for text in texts:
+            try:
+                results.append(self._link_batch([text])[0])
+            except Exception as e:
+                results.append(e)
+
+        return results
+
+    async def run(self):
+        """Collects queued texts into batches and links them, until cancelled"""
+
+        loop = asyncio.get_running_loop()
+        while True:
+
+            # Wait for the first text, then fill the batch until it is full or the deadline passes
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = [text for text, future, queued in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self._link_batch, texts)
+            except Exception as e:
+                # One text should not fail the other requests in its batch, retry them separately
+                if len(batch) == 1:
+                    results = [e]
+                else:
+                    results = await loop.run_in_executor(self.executor, self._link_each, texts)
+
+            # Hand the links, or the error of a text, to the waiting requests and record the metrics
+            finished = time.perf_counter()
+            for (text, future, queued), links in zip(batch, results):
+                self.latencies.append(finished - queued)
+                if future.done():
+                    continue
+                if isinstance(links, Exception):
+                    future.set_exception(links)
+                else:
+                    future.set_result(links)
+
+            self.n_texts += len(batch)
+            self.n_batches += 1
+            self.batch_sizes.append(len(batch))
+
+    def metrics(self):
+        """Returns queue depth, throughput counters and latency percentiles in milliseconds"""
+
+        metrics = {'queue_depth': self.queue.qsize(),
+                   'texts_linked': self.n_texts,
+                   'batches': self.n_batches,
+                   'mean_batch_size': round(float(np.mean(self.batch_sizes)), 2) if self.batch_sizes else None}
+
+        if self.latencies:
+            p50, p95, p99 = np.percentile(self.latencies, [50, 95, 99]) * 1000
+            metrics['latency_ms'] = {'p50': round(float(p50), 3), 'p95': round(float(p95), 3), 'p99': round(float(p99), 3)}
+
+        return metrics
+
+
+async def read_request(reader, max_body_size):
+    """
+    Reads one HTTP request from the connection
+
+    :return: the method, path, headers and body, or None when the client closed the connection
+    """
+
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+
+    method, path, version = request_line.decode('latin-1').split()
+
+    headers = dict()
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+
+    length = int(headers.get('content-length', 0))
+    if length > max_body_size:
+        raise ValueError(413)
+    body = await reader.readexactly(length) if length else b''
+
+    return method, path, headers, body
+
+
+def write_response(writer, status, payload, keep_alive):
+    """Writes a JSON response to the connection"""
+
+    body = json.dumps(payload, ensure_ascii=False).encode('utf8')
+    head = (f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(head.encode('latin-1') + body)
+
+
+async def route(batcher, method, path, body):
+    """
+    Handles a request and returns the status code and the response payload
+
+    POST /link with {"text": ...} returns the links of one text, with {"texts": [...]} the links
+    of every text. GET /metrics returns the batcher metrics and GET /health a status check.
+    """
+
+    # The query string is not used, it should not hide the path
+    path = path.split('?', 1)[0]
+
+    if path == '/health':
+        return 200, {'status': 'ok'}
+
+    if path == '/metrics':
+        return 200, batcher.metrics()
+
+    if path != '/link':
+        return 404, {'error': f"Unknown path {path}"}
+    if method != 'POST':
+        return 405, {'error': "Use POST to link texts"}
+
+    try:
+        request = json.loads(body)
+    except ValueError:
+        return 400, {'error': "The body should be JSON"}
+    if not isinstance(request, dict):
+        return 400, {'error': "The body should be a JSON object"}
+
+    if isinstance(request.get('text'), str):
+        return 200, {'links': await batcher.link(request['text'])}
+
+    texts = request.get('texts')
+    if isinstance(texts, list) and all(isinstance(text, str) for text in texts):
+        # Wait for every text, so the errors of all failed texts are retrieved, and report the first
+        results = await asyncio.gather(*[batcher.link(text) for text in texts], return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            raise errors[0]
+        return 200, {'results': [{'links': links} for links in results]}
+
+    return 400, {'error': "Provide a 'text' string or a 'texts' list"}
+
+
+def make_handler(batcher, max_body_size):
+    """Creates the connection handler, which serves requests until the client disconnects"""
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader, max_body_size)
+                except ValueError as e:
+                    status = e.args[0] if e.args and e.args[0] in STATUS_TEXT else 400
+                    write_response(writer, status, {'error': "Malformed or too large request"}, False)
+                    break
+
+                if request is None:
+                    break
+
+                method, path, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                # A text that fails to link gets an error response, the connection stays usable
+                try:
+                    status, payload = await route(batcher, method, path, body)
+                except Exception as e:
+                    status, payload = 500, {'error': f"Linking failed: {e!r}"}
+                write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def serve(nlp, host, port, max_batch_size, max_wait, max_body_size):
+    """Starts the micro-batcher and the HTTP server"""
+
+    batcher = MicroBatcher(nlp, max_batch_size, max_wait)
+    batch_task = asyncio.create_task(batcher.run())
+    server = await asyncio.start_server(make_handler(batcher, max_body_size), host, port)
+    print(f"Serving entity links on http://{host}:{port}/link")
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_task.cancel()
+        batcher.executor.shutdown(wait=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves the Entity Linker over HTTP.")
+    parser.add_argument('--model', default='resources/nen_nlp_el_sentence')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0, help="Maximum time a text waits for a batch")
+    parser.add_argument('--max-body-size', type=int, default=10 * 1024 ** 2)
+    args = parser.parse_args()
+
+    # Load the pipeline with the Knowledge Base once, before accepting requests
+    nlp = spacy.load(args.model)
+    asyncio.run(serve(nlp, args.host, args.port, args.max_batch_size, args.max_wait_ms / 1000, args.max_body_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,8 @@ from spacy.kb import KnowledgeBase
 from spacy.util import minibatch, compounding
 from sklearn.model_selection import train_test_split
 from statistics import mean
+from profiling import timer
+from progress import Progress
 
 
 def find_org_loc(doc, org):
@@ -32,7 +34,7 @@ def load_training_data(data_loc):
     TRAIN_DOCS = []
     n_sents = []
     no_match = 0
-    i = 0
+    progress = Progress('load_training_data', unit='samples')
 
     with open(data_loc, 'r', encoding='utf8') as infile:
         for line in infile:
@@ -43,10 +45,7 @@ def load_training_data(data_loc):
 
                 # Skip mentions that are labelled NIL
                 if line[-1] != 'NIL':
-
-                    # Print progress
-                    if i % 100 == 0:
-                        print(f"{i} samples preprocessed.")
+                    progress.update(training_samples=len(TRAIN_DOCS), no_match=no_match)
 
                     # Extract values from data
                     text = line[0]
@@ -70,11 +69,11 @@ def load_training_data(data_loc):
                         links_dict = {kvk: 1.0}
                         example = (doc, {"links": {offset: links_dict}})
                         TRAIN_DOCS.append(example)
-                        i += 1
                     except:
                         no_match += 1
                         continue
 
+    progress.close(training_samples=len(TRAIN_DOCS), no_match=no_match)
     print(f"Number of samples skipped due to no match NER: {no_match}")
     print(f"Mean number of sentences per article: {mean(n_sents)}")
     print(f"Max number of sentences per article: {max(n_sents)}")
@@ -121,15 +120,16 @@ def train_el():
             losses = {}
             for batch in batches:
                 texts, annotations = zip(*batch)
-                nlp.update(
-                    texts,
-                    annotations,
-
-                    # Prevent overfitting
-                    drop=0.2,
-                    losses=losses,
-                    sgd=optimizer,
-                )
+                with timer('nlp.update'):
+                    nlp.update(
+                        texts,
+                        annotations,
+
+                        # Prevent overfitting
+                        drop=0.2,
+                        losses=losses,
+                        sgd=optimizer,
+                    )
 
             # Print progress and losses
             if itn % 1 == 0:
@@ -1,11 +1,14 @@
 import pandas as pd
 import numpy as np
+import os
 import re
+import shutil
 from scipy.sparse import csr_matrix
 import sparse_dot_topn.sparse_dot_topn as ct
 from string import punctuation
 import spacy
 from collections import defaultdict
+from profiling import timed
 
 chars_to_remove = ['"', "'", "[", "]"]
 
@@ -36,6 +39,164 @@ def string_to_list(series):
     return series_list
 
 
+def clean_joined(texts):
+    """
+    Cleans many texts like clean_element, in one pass over their joined text
+
+    :param texts: the texts to clean
+    :return: the joined text with the characters removed and lowercased, or None if a text contains the separator
+    """
+
+    # Join all texts with a character that does not occur in them
+    text = '\x00'.join(texts)
+    if text.count('\x00') != len(texts) - 1:
+        return None
+
+    # Remove characters and lowercase all texts at once, none of the removed characters is a comma.
+    # str.replace is used instead of str.translate, which looks up every character and is several times slower
+    for char in chars_to_remove:
+        text = text.replace(char, '')
+
+    return text.lower()
+
+
+def clean_elements(texts):
+    """Fast version of clean_element for many texts, gives the same output"""
+
+    texts = list(texts)
+    if not texts:
+        return []
+
+    text = clean_joined(texts)
+    if text is None:
+        return [clean_element(text) for text in texts]
+
+    return [element.strip() for element in text.split('\x00')]
+
+
+def strings_to_lists(series, unique=False):
+    """
+    Fast version of string_to_list, that cleans all entries of a series in one pass over their joined text
+
+    :param series: the strings to transform, such as "['name one', 'name two']"
+    :param unique: whether to remove repeated elements from each list, like preprocess_orgs did after parsing
+    :return: the lists of cleaned elements, identical to the output of string_to_list
+    :rtype: list
+    """
+
+    series = list(series)
+    if not series:
+        return []
+
+    text = clean_joined(series)
+    if text is None:
+        lists = string_to_list(series)
+    else:
+        strip = str.strip
+        lists = [list(map(strip, elements.split(','))) for elements in text.split('\x00')]
+
+    if unique:
+        return [list(set(elements)) for elements in lists]
+
+    return lists
+
+
+def table_path(path):
+    """Returns the Parquet version of a .tsv table if it exists, and the .tsv path otherwise"""
+
+    parquet_path = re.sub(r'\.tsv$', '.parquet', path)
+    if parquet_path != path and os.path.exists(parquet_path):
+        return parquet_path
+
+    return path
+
+
+def save_table(df, path, part=None):
+    """
+    Saves a dataframe in Parquet format, with list columns stored as native lists
+
+    :param df: the dataframe to save
+    :param path: path to the .parquet file, or to the dataset directory if a part is given
+    :param part: the number of the part file within the dataset directory
+    """
+
+    if part is not None:
+        os.makedirs(path, exist_ok=True)
+        path = os.path.join(path, f"part-{part:05d}.parquet")
+
+    df.to_parquet(path, index=False)
+
+
+def clear_table(path):
+    """Removes a saved Parquet file or dataset directory"""
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def next_part(path):
+    """Returns the number of the next part file in a Parquet dataset directory"""
+
+    if not os.path.isdir(path):
+        return 0
+
+    return len([name for name in os.listdir(path) if name.startswith('part-')])
+
+
+def canonical_kvk(kvk_numbers):
+    """Returns KvK-numbers as 8-digit strings with their leading zeros, the form of the annotations and entities.tsv"""
+
+    return kvk_numbers.astype(str).str.zfill(8)
+
+
+def load_table(path, columns=None, list_columns=()):
+    """
+    Loads a table from Parquet if available, or from the .tsv file otherwise
+
+    :param path: path to the .tsv file, a .parquet file or dataset directory next to it is preferred
+    :param columns: the columns to load, all columns if None
+    :param list_columns: columns that hold lists, these are parsed when loading from .tsv
+    :return: the loaded table
+    :rtype: pandas.core.frame.DataFrame
+    """
+
+    path = table_path(path)
+
+    if path.endswith('.parquet'):
+        df = pd.read_parquet(path, columns=columns)
+        for column in list_columns:
+            if column in df:
+                df[column] = [list(elements) for elements in df[column]]
+
+    # The .tsv files store lists as strings
+    else:
+        df = pd.read_csv(path, sep='\t', usecols=columns, dtype={'kvk_number': str})
+        for column in list_columns:
+            if column in df:
+                df[column] = strings_to_lists(df[column])
+
+    # Parsed as numbers, KvK-numbers would lose their leading zero, both formats give the same strings
+    if 'kvk_number' in df:
+        df['kvk_number'] = canonical_kvk(df['kvk_number'])
+
+    return df
+
+
+def load_companies(path='../data/model_data/prepro_companies.tsv', columns=None):
+    """Loads the preprocessed company database with the company names as lists"""
+
+    return load_table(path, columns, list_columns=['all_names'])
+
+
+def load_news(path='../data/model_data/prepro_news.tsv', columns=None):
+    """Loads the preprocessed news database with the organisations as lists"""
+
+    return load_table(path, columns, list_columns=['orgs'])
+
+
+@timed
 def get_orgs(text, nlp):
     """
 
@@ -44,13 +205,24 @@ def get_orgs(text, nlp):
     :return: The entities that were extracted from the doc
     :rtype: list
     """
+    return doc_orgs(nlp(text))
+
+
+def doc_orgs(doc):
+    """
+    Extracts the first ORG/NORP entity of each distinct company mention from a processed doc
+
+    :param doc: the spaCy doc, for example from nlp.pipe
+    :return: The entities that were extracted from the doc
+    :rtype: list
+    """
     orgs = []
-    doc = nlp(text)
+    org_texts = set()
     for ent in doc.ents:
         if ent.label_ in ['ORG', 'NORP']:
             if ent.text not in punctuation:
-                org_texts = [ent.text for ent in orgs]
                 if ent.text not in org_texts:
+                    org_texts.add(ent.text)
                     orgs.append(ent)
 
     return orgs
@@ -81,6 +253,36 @@ def get_orgs_sent(text, nlp):
     return orgs_sents
 
 
+def get_vectors(texts, nlp, normalise=False, batch_size=256):
+    """
+    Encodes texts as document vectors, running each unique text through the pipeline only once
+
+    :param texts: the texts to encode
+    :param nlp: the nlp object used to compute the document vectors
+    :param normalise: whether to scale every vector to unit (L2) length
+    :param batch_size: the number of texts per nlp.pipe batch
+    :return: a matrix with one document vector per text
+    :rtype: numpy.ndarray
+    """
+
+    # Encode every distinct text once, most descriptions are shared by many companies
+    unique_texts = list(dict.fromkeys(texts))
+    rows = {text: n for n, text in enumerate(unique_texts)}
+
+    # The tagger is kept, because models without word vectors derive doc.vector from its tensor
+    disabled = [pipe for pipe in nlp.pipe_names if pipe != 'tagger']
+    vectors = [doc.vector for doc in nlp.pipe(unique_texts, batch_size=batch_size, disable=disabled)]
+    vectors = np.array(vectors, dtype=np.float32).reshape(len(unique_texts), -1)
+
+    # Scale vectors to unit length, so that dot products are cosine similarities
+    if normalise:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        vectors = vectors / norms
+
+    return vectors[[rows[text] for text in texts]]
+
+
 def ngrams_chars(string, n=3):
     # string = fix_text(string)  # fix text encoding issues
     if pd.isna(string):
@@ -103,6 +305,7 @@ def ngrams_chars(string, n=3):
     return n_gramlist
 
 
+@timed
 def awesome_cossim_top(A, B, ntop, lower_bound=0.0):
     # force A and B as a CSR matrix.
     # If they have already been CSR, there is no overhead
@@ -131,6 +334,7 @@ def awesome_cossim_top(A, B, ntop, lower_bound=0.0):
     return csr_matrix((data, indices, indptr), shape=(M, N))
 
 
+@timed
 def resolve_org(dirty_name, vectorizer, clean_matrix, companies):
     dirty_matrix = vectorizer.transform([dirty_name])
     try: